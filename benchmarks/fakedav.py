@@ -0,0 +1,301 @@
+# coding=utf-8
+"""
+Minimal in-memory WebDAV server to benchmark the upload pipeline against.
+
+Only the parts of WebDAV the plugin uses are implemented: HEAD, MKCOL, PUT (including Content-Range
+and Nextcloud chunked uploads), MOVE, COPY, DELETE and PROPFIND with quota, size, ETag and modification
+time. File contents are not kept, only their sizes, so the server uses hardly any memory itself.
+
+Latency is added to every request, bandwidth is shared by all connections like a single uplink would be.
+
+GET /__stats returns the request and connection counters as JSON, POST /__reset clears everything.
+
+Run standalone with: python benchmarks/fakedav.py --port 8080 --latency 0.02 --bandwidth 1000
+"""
+from __future__ import absolute_import
+import argparse
+import json
+import posixpath
+import sys
+import threading
+import time
+from collections import Counter
+from email.utils import formatdate
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, unquote, quote
+from xml.sax.saxutils import escape
+
+
+class Link(object):
+    # A shared uplink, transfers queue up behind each other
+    def __init__(self, bandwidth=0):
+        self._bandwidth = bandwidth
+        self._lock = threading.Lock()
+        self._busy_until = 0.0
+
+    def transfer(self, size):
+        if not self._bandwidth or not size:
+            return
+        with self._lock:
+            start = max(time.time(), self._busy_until)
+            self._busy_until = start + float(size) / self._bandwidth
+            wait = self._busy_until - time.time()
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Store(object):
+    def __init__(self, quota=10 ** 12):
+        self.lock = threading.Lock()
+        self.quota = quota
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # path: (size, modified)
+            self.files = {}
+            self.dirs = {"/"}
+            self.requests = Counter()
+            self.connections = 0
+            self.bytes_received = 0
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                requests=dict(self.requests),
+                total_requests=sum(self.requests.values()),
+                connections=self.connections,
+                bytes_received=self.bytes_received,
+                files=len(self.files),
+                directories=len(self.dirs),
+            )
+
+
+def make_handler(store, latency=0.0, link=None, deny_infinity=False):
+    link = link or Link()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            BaseHTTPRequestHandler.setup(self)
+            with store.lock:
+                store.connections += 1
+
+        def log_message(self, *args):
+            pass
+
+        def _path(self, url=None):
+            path = posixpath.normpath(unquote(urlsplit(url or self.path).path))
+            return "/" if path in (".", "") else path
+
+        def _reply(self, code, body=b"", headers=None):
+            self.send_response(code)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _read(self, size):
+            # Read and throw away, in blocks so bandwidth is spread over the transfer
+            received = 0
+            while received < size:
+                data = self.rfile.read(min(65536, size - received))
+                if not data:
+                    break
+                received += len(data)
+                link.transfer(len(data))
+            return received
+
+        def _body(self):
+            if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+                received = 0
+                while True:
+                    size = int(self.rfile.readline().strip().split(b";")[0], 16)
+                    if size == 0:
+                        self.rfile.readline()
+                        break
+                    received += self._read(size)
+                    self.rfile.readline()
+            else:
+                received = self._read(int(self.headers.get("Content-Length") or 0))
+            with store.lock:
+                store.bytes_received += received
+            return received
+
+        def _start(self):
+            with store.lock:
+                store.requests[self.command] += 1
+            if latency:
+                time.sleep(latency)
+
+        def do_GET(self):
+            if self.path == "/__stats":
+                return self._reply(200, json.dumps(store.stats()).encode("utf-8"), {"Content-Type": "application/json"})
+            self._start()
+            self._reply(404)
+
+        def do_POST(self):
+            if self.path == "/__reset":
+                self._body()
+                store.reset()
+                return self._reply(204)
+            self._start()
+            self._reply(405)
+
+        def do_HEAD(self):
+            self._start()
+            path = self._path()
+            with store.lock:
+                found = path in store.dirs or path in store.files
+            self._reply(200 if found else 404)
+
+        def do_MKCOL(self):
+            self._start()
+            self._body()
+            path = self._path()
+            with store.lock:
+                if path in store.dirs or path in store.files:
+                    return self._reply(405)
+                if posixpath.dirname(path) not in store.dirs:
+                    return self._reply(409)
+                store.dirs.add(path)
+            self._reply(201)
+
+        def do_PUT(self):
+            self._start()
+            size = self._body()
+            path = self._path()
+            with store.lock:
+                if posixpath.dirname(path) not in store.dirs:
+                    return self._reply(409)
+                content_range = self.headers.get("Content-Range")
+                if content_range:
+                    start = int(content_range.split(" ")[1].split("-")[0])
+                    if start > store.files.get(path, (0, 0))[0]:
+                        return self._reply(416)
+                    size += start
+                store.files[path] = (size, time.time())
+            self._reply(201, headers={"ETag": '"%x-%x"' % (size, int(time.time() * 1000))})
+
+        def do_DELETE(self):
+            self._start()
+            path = self._path()
+            with store.lock:
+                if path in store.files:
+                    del store.files[path]
+                elif path in store.dirs:
+                    store.dirs = set(d for d in store.dirs if not (d == path or d.startswith(path + "/")))
+                    store.files = dict((f, v) for f, v in store.files.items() if not f.startswith(path + "/"))
+                else:
+                    return self._reply(404)
+            self._reply(204)
+
+        def do_MOVE(self):
+            self._start()
+            source = self._path()
+            destination = self._path(self.headers["Destination"])
+            with store.lock:
+                if source.endswith("/.file"):
+                    # Nextcloud chunked upload, assemble all chunks in the upload directory
+                    directory = posixpath.dirname(source)
+                    if directory not in store.dirs:
+                        return self._reply(404)
+                    chunks = [f for f in store.files if posixpath.dirname(f) == directory]
+                    if posixpath.dirname(destination) not in store.dirs:
+                        return self._reply(409)
+                    store.files[destination] = (sum(store.files[f][0] for f in chunks), time.time())
+                    for f in chunks:
+                        del store.files[f]
+                    store.dirs.discard(directory)
+                    return self._reply(201)
+                if source not in store.files:
+                    return self._reply(404)
+                if posixpath.dirname(destination) not in store.dirs:
+                    return self._reply(409)
+                if destination in store.files and self.headers.get("Overwrite", "T") == "F":
+                    return self._reply(412)
+                store.files[destination] = store.files.pop(source)
+            self._reply(201)
+
+        def do_COPY(self):
+            self._start()
+            source = self._path()
+            destination = self._path(self.headers["Destination"])
+            with store.lock:
+                if source not in store.files:
+                    return self._reply(404)
+                if posixpath.dirname(destination) not in store.dirs:
+                    return self._reply(409)
+                if destination in store.files and self.headers.get("Overwrite", "T") == "F":
+                    return self._reply(412)
+                store.files[destination] = (store.files[source][0], time.time())
+            self._reply(201)
+
+        def do_PROPFIND(self):
+            self._start()
+            self._body()
+            path = self._path()
+            depth = self.headers.get("Depth", "infinity").strip()
+            if depth == "infinity" and deny_infinity:
+                return self._reply(403)
+            with store.lock:
+                if path not in store.dirs and path not in store.files:
+                    return self._reply(404)
+                entries = [path]
+                if path in store.dirs and depth != "0":
+                    prefix = path.rstrip("/") + "/"
+                    for child in sorted(store.dirs | set(store.files)):
+                        if child != path and child.startswith(prefix):
+                            if depth == "1" and "/" in child[len(prefix):]:
+                                continue
+                            entries.append(child)
+                response = ['<?xml version="1.0"?><d:multistatus xmlns:d="DAV:">']
+                for entry in entries:
+                    isdir = entry in store.dirs
+                    if isdir:
+                        props = "<d:resourcetype><d:collection/></d:resourcetype>"
+                        if entry == path:
+                            props += "<d:quota-available-bytes>%d</d:quota-available-bytes><d:quota-used-bytes>0</d:quota-used-bytes>" % store.quota
+                    else:
+                        size, modified = store.files[entry]
+                        props = "<d:resourcetype/><d:getcontentlength>%d</d:getcontentlength>" % size
+                        props += "<d:getetag>\"%x-%x\"</d:getetag>" % (size, int(modified * 1000))
+                        props += "<d:getlastmodified>%s</d:getlastmodified>" % formatdate(modified, usegmt=True)
+                    href = quote(entry + ("/" if isdir and entry != "/" else ""))
+                    response.append("<d:response><d:href>%s</d:href><d:propstat><d:prop>%s</d:prop><d:status>HTTP/1.1 200 OK</d:status></d:propstat></d:response>" % (escape(href), props))
+                response.append("</d:multistatus>")
+            self._reply(207, "".join(response).encode("utf-8"), {"Content-Type": "application/xml"})
+
+    return Handler
+
+
+def serve(port=0, latency=0.0, bandwidth=0, deny_infinity=False):
+    # Bandwidth in bytes per second, 0 is unlimited
+    store = Store()
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(store, latency, Link(bandwidth), deny_infinity))
+    server.daemon_threads = True
+    return server, store
+
+
+def main():
+    parser = argparse.ArgumentParser(description="In-memory WebDAV server for benchmarks")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--bandwidth", type=float, default=0, help="upload bandwidth in KB/s, 0 is unlimited")
+    parser.add_argument("--deny-infinity", action="store_true", help="refuse PROPFIND with Depth: infinity")
+    args = parser.parse_args()
+
+    server, store = serve(args.port, args.latency, args.bandwidth * 1024, args.deny_infinity)
+    # The benchmark runner reads the address from the first line
+    print("http://127.0.0.1:%d" % server.server_address[1])
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
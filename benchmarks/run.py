@@ -0,0 +1,331 @@
+# coding=utf-8
+"""
+Replays synthetic event streams through the plugin against a local WebDAV server and reports what it cost.
+
+Scenarios:
+    backups     a few large backups (plugin_backup_backup_created)
+    snapshots   a burst of timelapse snapshots (CaptureDone), optionally batched or sent as tar archives
+    files       a bulk import of files into the uploads folder (FileAdded), a part of them filtered out
+
+Modes:
+    plugin      the current upload pipeline, events go through on_event and the upload queue
+    baseline    the original flow, a new client per event with check/free, recursive path creation,
+                upload_sync and move, all on the event thread
+
+For every run the number of WebDAV requests per event, connections opened, wall time, throughput and the
+peak Python memory use (tracemalloc) are reported. The server runs in its own process so it doesn't show
+up in the memory figures, it has configurable latency and bandwidth to mimic a remote server.
+
+Examples:
+    python benchmarks/run.py
+    python benchmarks/run.py --scenario files --count 5000 --latency 0.05
+    python benchmarks/run.py --scenario snapshots --snapshot-batch --mode plugin --json
+"""
+from __future__ import absolute_import
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from os import path as ospath
+from urllib.request import urlopen, Request
+
+sys.path.insert(0, ospath.dirname(ospath.dirname(ospath.abspath(__file__))))
+
+from webdav3.client import Client
+import octoprint_webdavbackup
+
+SCENARIOS = ("backups", "snapshots", "files")
+MODES = ("plugin", "baseline")
+
+
+class BenchmarkSettings(object):
+    # Just enough of OctoPrint's settings object for the plugin to run
+    def __init__(self, defaults, overrides, base_folder):
+        self._values = dict(defaults)
+        self._values.update(overrides)
+        self._base_folder = base_folder
+
+    def get(self, path, **kwargs):
+        value = self._values
+        for key in path:
+            if not isinstance(value, dict):
+                return None
+            value = value.get(key)
+        return value
+
+    def get_int(self, path, **kwargs):
+        value = self.get(path)
+        return None if value is None else int(value)
+
+    def get_float(self, path, **kwargs):
+        value = self.get(path)
+        return None if value is None else float(value)
+
+    def get_boolean(self, path, **kwargs):
+        return bool(self.get(path))
+
+    def set(self, path, value, **kwargs):
+        values = self._values
+        for key in path[:-1]:
+            values = values.setdefault(key, dict())
+        values[path[-1]] = value
+
+    def getBaseFolder(self, name, **kwargs):
+        folder = ospath.join(self._base_folder, name)
+        os.makedirs(folder, exist_ok=True)
+        return folder
+
+    def save(self, **kwargs):
+        pass
+
+
+class BenchmarkPrinter(object):
+    def is_printing(self):
+        return False
+
+
+class Server(object):
+    def __init__(self, latency, bandwidth):
+        self._process = subprocess.Popen(
+            [sys.executable, ospath.join(ospath.dirname(ospath.abspath(__file__)), "fakedav.py"), "--latency", str(latency), "--bandwidth", str(bandwidth)],
+            stdout=subprocess.PIPE, universal_newlines=True,
+        )
+        self.url = self._process.stdout.readline().strip()
+
+    def reset(self):
+        urlopen(Request(self.url + "/__reset", data=b"", method="POST")).read()
+
+    def stats(self):
+        return json.loads(urlopen(self.url + "/__stats").read().decode("utf-8"))
+
+    def stop(self):
+        self._process.terminate()
+        self._process.wait()
+
+
+def _write_file(file_path, size):
+    os.makedirs(ospath.dirname(file_path), exist_ok=True)
+    with open(file_path, "wb") as f:
+        # Random data so compression doesn't make it look better than it is
+        block = os.urandom(min(size, 1024 * 1024))
+        written = 0
+        while written < size:
+            f.write(block[:size - written])
+            written += len(block)
+
+
+def make_events(scenario, base_folder, count, size):
+    # The files are created up front, only the uploads are measured
+    events = []
+    if scenario == "backups":
+        for i in range(count):
+            name = "octoprint-backup-%05d.zip" % i
+            file_path = ospath.join(base_folder, "data", "backup", name)
+            _write_file(file_path, size)
+            events.append(("plugin_backup_backup_created", dict(path=file_path, name=name)))
+    elif scenario == "snapshots":
+        for i in range(count):
+            file_path = ospath.join(base_folder, "timelapse", "tmp", "benchmark-%05d.jpg" % i)
+            _write_file(file_path, size)
+            events.append(("CaptureDone", dict(file=file_path)))
+    elif scenario == "files":
+        for i in range(count):
+            # One in four doesn't match the filter, like the extra files of a bulk import
+            name = "part-%05d.%s" % (i, "txt" if i % 4 == 3 else "gcode")
+            relative_path = ospath.join("import", "folder-%02d" % (i % 10), name)
+            _write_file(ospath.join(base_folder, "uploads", relative_path), size)
+            events.append(("FileAdded", dict(storage="local", path=relative_path, name=name, type=["machinecode", "gcode"])))
+    return events
+
+
+def make_plugin(server_url, base_folder, overrides):
+    plugin = octoprint_webdavbackup.WebDavBackupPlugin()
+    settings = dict(
+        server=server_url,
+        username="benchmark",
+        password="benchmark",
+        upload_path="/backups/%Y/%m",
+        upload_timelapse_path="/timelapse/%Y-%m-%d",
+        upload_timelapse_snapshots=True,
+        upload_other=True,
+        upload_other_path="/files",
+        upload_other_full_path=True,
+        retry_delay=1,
+    )
+    settings.update(overrides)
+    plugin._settings = BenchmarkSettings(plugin.get_settings_defaults(), settings, base_folder)
+    plugin._printer = BenchmarkPrinter()
+    plugin._basefolder = ospath.dirname(octoprint_webdavbackup.__file__)
+    plugin._identifier = "webdavbackup"
+    plugin._plugin_version = "benchmark"
+    plugin._event_bus = None
+    plugin._plugin_manager = None
+    data_folder = ospath.join(base_folder, "plugin_data")
+    os.makedirs(data_folder, exist_ok=True)
+    plugin.get_plugin_data_folder = lambda: data_folder
+    plugin.initialize()
+    plugin.on_after_startup()
+    return plugin
+
+
+def wait_for_queue(plugin, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        status = plugin._upload_queue.get_status()
+        if status["depth"] == 0 and all(job["status"] not in ("queued", "uploading") for job in status["jobs"]):
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def baseline_upload(davoptions, local_file_path, upload_path, upload_name, overwrite):
+    # The per-event flow this plugin started out with
+    davclient = Client(davoptions)
+    if not davclient.check("/"):
+        raise Exception("WebDAV root not found")
+
+    def _recursive_create_path(path):
+        path = ospath.join("/", path)
+        if davclient.check(path):
+            return True
+        if path != "/" and _recursive_create_path(ospath.abspath(ospath.join(path, ".."))):
+            davclient.mkdir(path)
+            return True
+        return False
+
+    upload_file = ospath.join("/", upload_path, upload_name)
+    upload_temp = upload_file + ".tmp"
+    if _recursive_create_path(upload_path):
+        davclient.upload_sync(remote_path=upload_temp, local_path=local_file_path)
+        davclient.move(remote_path_from=upload_temp, remote_path_to=upload_file, overwrite=overwrite)
+
+
+def run(server, scenario, mode, args):
+    base_folder = tempfile.mkdtemp(prefix="webdavbackup-benchmark-")
+    try:
+        events = make_events(scenario, base_folder, args.count, args.size * 1024)
+        overrides = dict(
+            upload_workers=args.workers,
+            upload_queue_size=max(32, len(events)),
+            chunked_upload=not args.no_chunked,
+            snapshot_batch=args.snapshot_batch,
+            snapshot_batch_tar=args.snapshot_tar,
+        )
+        plugin = make_plugin(server.url, base_folder, overrides)
+        davoptions = plugin._get_davoptions()
+        server.reset()
+
+        uploads = 0
+        failures = 0
+        # webdav3 prints every directory it creates
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            tracemalloc.start()
+            started = time.time()
+            for event, payload in events:
+                if mode == "plugin":
+                    plugin.on_event(event, payload)
+                    continue
+                if event == "FileAdded" and not plugin._accept_file_added(payload):
+                    continue
+                job = plugin._create_upload_job(event, payload)
+                try:
+                    baseline_upload(davoptions, job.local_file_path, job.upload_path, job.upload_name or ospath.basename(job.local_file_path), job.overwrite)
+                    uploads += 1
+                except Exception:
+                    failures += 1
+            if mode == "plugin":
+                # Sends out a partial snapshot batch
+                plugin.on_event("PrintDone", dict())
+                if not wait_for_queue(plugin, args.timeout):
+                    logging.getLogger("benchmark").warning("Upload queue did not drain within " + str(args.timeout) + " seconds")
+                metrics = plugin._metrics.as_dict()
+                uploads = metrics["uploads"].get("success", 0)
+                failures = metrics["uploads"].get("failure", 0)
+            wall_time = time.time() - started
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        plugin.on_shutdown()
+        stats = server.stats()
+        return dict(
+            scenario=scenario,
+            mode=mode,
+            events=len(events),
+            uploads=uploads,
+            failures=failures,
+            requests=stats["total_requests"],
+            requests_by_method=stats["requests"],
+            requests_per_event=round(float(stats["total_requests"]) / len(events), 2) if events else 0,
+            connections=stats["connections"],
+            wall_time=round(wall_time, 3),
+            bytes=stats["bytes_received"],
+            throughput=round(stats["bytes_received"] / wall_time / 1024 / 1024, 2) if wall_time > 0 else 0,
+            peak_memory=round(peak_memory / 1024.0 / 1024.0, 2),
+        )
+    finally:
+        shutil.rmtree(base_folder, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the WebDAV upload pipeline against a local WebDAV server")
+    parser.add_argument("--scenario", choices=SCENARIOS + ("all",), default="all")
+    parser.add_argument("--mode", choices=MODES + ("both",), default="both")
+    parser.add_argument("--count", type=int, help="events per scenario (default: 5 backups, 200 snapshots, 1000 files)")
+    parser.add_argument("--size", type=int, help="file size in KB (default: 20480 for backups, 100 for snapshots, 20 for files)")
+    parser.add_argument("--latency", type=float, default=0.01, help="seconds the server adds to every request")
+    parser.add_argument("--bandwidth", type=float, default=0, help="server bandwidth in KB/s, 0 is unlimited")
+    parser.add_argument("--workers", type=int, default=2, help="upload workers of the plugin")
+    parser.add_argument("--no-chunked", action="store_true", help="disable chunked uploads")
+    parser.add_argument("--snapshot-batch", action="store_true", help="batch snapshots")
+    parser.add_argument("--snapshot-tar", action="store_true", help="send snapshot batches as a tar archive")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds to wait for the upload queue to drain")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.ERROR)
+
+    scenarios = SCENARIOS if args.scenario == "all" else (args.scenario,)
+    modes = MODES if args.mode == "both" else (args.mode,)
+    defaults = dict(backups=(5, 20480), snapshots=(200, 100), files=(1000, 20))
+
+    server = Server(args.latency, args.bandwidth)
+    results = []
+    try:
+        for scenario in scenarios:
+            scenario_args = argparse.Namespace(**vars(args))
+            scenario_args.count = defaults[scenario][0] if args.count is None else args.count
+            scenario_args.size = defaults[scenario][1] if args.size is None else args.size
+            for mode in modes:
+                results.append(run(server, scenario, mode, scenario_args))
+                if not args.json:
+                    _print_result(results[-1], header=len(results) == 1)
+    finally:
+        server.stop()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+def _print_result(result, header=False):
+    columns = (
+        ("scenario", "%-10s"), ("mode", "%-9s"), ("events", "%7s"), ("uploads", "%8s"), ("failures", "%9s"),
+        ("requests", "%9s"), ("requests_per_event", "%10s"), ("connections", "%12s"),
+        ("wall_time", "%9s"), ("throughput", "%8s"), ("peak_memory", "%8s"),
+    )
+    titles = dict(requests_per_event="req/event", wall_time="wall s", throughput="MB/s", peak_memory="peak MB")
+    if header:
+        print(" ".join(fmt % titles.get(name, name) for name, fmt in columns))
+    print(" ".join(fmt % result[name] for name, fmt in columns))
+    sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
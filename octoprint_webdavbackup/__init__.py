@@ -2,26 +2,198 @@
 from __future__ import absolute_import
 from os import path as ospath
 from os import remove as osremove
+from os import stat as osstat
 import math
+import threading
+import time
 import logging
-from webdav3.client import Client
-from webdav3.exceptions import WebDavException, ResponseErrorCode, RemoteResourceNotFound, RemoteParentNotFound
-from fnmatch import fnmatch as fn
-from datetime import datetime
+from webdav3.exceptions import WebDavException, ResponseErrorCode, RemoteResourceNotFound, RemoteParentNotFound, NotEnoughSpace
+from datetime import datetime, timezone
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from http import HTTPStatus
+import flask
+import requests
 import octoprint.plugin
 from octoprint.events import Events, eventManager
-from octoprint.server import user_permission
+from octoprint.access.permissions import Permissions, UnknownPermission
 from octoprint.settings import settings
+from octoprint.util import RepeatedTimer
+from .backup import backup_contents, backup_excludes, backup_hooks, backup_name
+from .chunked import ChunkedUpload
+from .client import ClientPool, upload_file as dav_upload_file, upload_stream as dav_upload_stream, move as dav_move, copy as dav_copy, delete as dav_delete, properties as dav_properties
+from .dedupe import ContentIndex, file_sha256
+from .dircache import RemoteDirectoryCache
+from .filters import FileFilter
+from .freespace import FreeSpaceTracker
+from .metrics import UploadMetrics
+from .retention import RetentionPolicy, is_specific, list_files as dav_list_files, prune as dav_prune, static_prefix, template_pattern
+from .journal import UploadJournal, UPLOADING as JOURNAL_UPLOADING
+from .snapshots import SnapshotBatcher
+from .sync import local_files, is_outdated
+from .throttle import TokenBucket
+from .streams import IterStream, Tee, read_file, tar_size, tar_stream, zip_stream, compress_stream, zstandard, COMPRESSION_SUFFIXES
+from .upload_queue import UploadJob, UploadQueue
+
+# Lower goes first: timelapses are wanted soonest, other files can wait
+_UPLOAD_PRIORITIES = {
+    "MovieDone": 0,
+    "plugin_backup_backup_created": 1,
+    "CaptureDone": 1,
+    "FileAdded": 2,
+}
+
+# Upload kinds with a retention policy, by the event that creates them
+_RETENTION_KINDS = {
+    "plugin_backup_backup_created": "backup",
+    "MovieDone": "timelapse",
+}
+
+_TIMELAPSE_EXTENSIONS = (".mp4", ".mpg", ".mkv", ".avi", ".webm", ".gif", ".m4v", ".mov")
+
+# Settings that can differ per upload target
+_TARGET_SETTINGS = (
+    "server",
+    "username",
+    "password",
+    "timeout",
+    "verify_certificate",
+    "check_space",
+    "disable_path_check",
+    "upload_path",
+    "upload_name",
+    "upload_timelapse_path",
+    "upload_timelapse_name",
+    "upload_other_path",
+    "upload_other_filter",
+    "upload_other_full_path",
+)
+
+# Helper function for human readable sizes
+def _convert_size(size_bytes):
+    if size_bytes == 0:
+        return "0B"
+    size_name = ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")
+    i = int(math.floor(math.log(size_bytes, 1024)))
+    p = math.pow(1024, i)
+    s = round(size_bytes / p, 2)
+    return "%s %s" % (s, size_name[i])
+
+# Helper function for readable HTTP errors
+def _http_error(exception):
+    status = HTTPStatus(exception.code)
+    error_switcher = {
+        400: "Bad request",
+        401: "Unauthorized",
+        403: "Forbidden",
+        404: "Not found",
+        405: "Method not allowed",
+        408: "Request timeout",
+        500: "Internal error",
+        501: "Not implemented",
+        502: "Bad gateway",
+        503: "Service unavailable",
+        504: "Gateway timeout",
+        508: "Loop detected",
+    }
+    if (exception.code == 401):
+        return "HTTP error 401 encountered, your credentials are most likely wrong."
+    return "HTTP error encountered: " + str(status.value) + " " + error_switcher.get(exception.code, status.phrase)
+
+# Server errors and timeouts are worth another try, other client errors are not
+def _is_transient(code):
+    return code in (408, 423, 425, 429) or code >= 500
 
 class WebDavBackupPlugin(octoprint.plugin.SettingsPlugin,
                               octoprint.plugin.AssetPlugin,
                               octoprint.plugin.TemplatePlugin,
                               octoprint.plugin.EventHandlerPlugin,
+                              octoprint.plugin.StartupPlugin,
+                              octoprint.plugin.ShutdownPlugin,
+                              octoprint.plugin.SimpleApiPlugin,
+                              octoprint.plugin.BlueprintPlugin,
 ):
 
     def __init__(self):
         self._logger = logging.getLogger(__name__)
+        self._upload_queue = None
+        self._upload_journal = None
+        self._content_index = None
+        self._server_capabilities = dict()
+        self._rate_limits = (0, 0)
+        self._file_filters = OrderedDict()
+        self._compress_filter = None
+        self._dav_clients = ClientPool(throttle=TokenBucket(self._current_rate))
+        self._dav_dirs = RemoteDirectoryCache()
+        self._dav_free = FreeSpaceTracker()
+        self._metrics = UploadMetrics()
+        self._retention_lock = threading.Lock()
+        self._retention_timer = None
+        self._sync_lock = threading.Lock()
+        self._sync_thread = None
+        self._sync_timer = None
+        self._sync_stop = threading.Event()
+        self._sync_status = dict(running=False, started=None, finished=None, checked=0, queued=0)
+        self._backup_lock = threading.Lock()
+        self._backup_thread = None
+        self._backup_timer = None
+        self._backup_status = dict(running=False, deferred=False, started=None, finished=None, name=None, size=0, error=None)
+        self._snapshot_batcher = SnapshotBatcher(self._upload_snapshot_batch)
+
+    def initialize(self):
+        self._configure_rate_limits()
+        self._configure_filters()
+        self._snapshot_batcher.configure(
+            self._settings.get_int(["snapshot_batch_size"]),
+            self._settings.get_int(["snapshot_batch_window"]),
+        )
+        self._dav_dirs.set_ttl(self._settings.get_int(["directory_cache_ttl"]))
+        self._dav_free.set_refresh_interval(self._settings.get_int(["free_space_refresh"]))
+        self._dav_clients.configure(
+            self._settings.get_int(["connection_pool_size"]),
+            self._settings.get_int(["connection_idle_timeout"]),
+        )
+        self._upload_journal = UploadJournal(ospath.join(self.get_plugin_data_folder(), "journal.db"))
+        self._content_index = ContentIndex(ospath.join(self.get_plugin_data_folder(), "journal.db"))
+        self._upload_queue = UploadQueue(
+            self._process_upload,
+            workers=self._settings.get_int(["upload_workers"]),
+            max_size=self._settings.get_int(["upload_queue_size"]),
+            journal=self._upload_journal,
+            max_attempts=self._settings.get_int(["retry_max_attempts"]),
+            retry_delay=self._settings.get_int(["retry_delay"]),
+            max_retry_delay=self._settings.get_int(["retry_max_delay"]),
+            hold=self._hold_upload,
+        )
+        self._upload_queue.start()
+
+    ##~~ StartupPlugin mixin
+    def on_after_startup(self):
+        # Keep finished entries around for a while, so duplicate events are still recognized
+        self._upload_journal.prune(max_age=30 * 24 * 3600)
+        self._upload_queue.replay()
+        self._schedule_retention()
+        self._schedule_sync()
+        self._schedule_backup()
+
+    ##~~ ShutdownPlugin mixin
+    def on_shutdown(self):
+        if self._retention_timer is not None:
+            self._retention_timer.cancel()
+        if self._sync_timer is not None:
+            self._sync_timer.cancel()
+        if self._backup_timer is not None:
+            self._backup_timer.cancel()
+        self._sync_stop.set()
+        self._snapshot_batcher.flush()
+        if self._upload_queue is not None:
+            self._logger.info("Waiting for " + str(self._upload_queue.depth()) + " queued uploads to finish.")
+            self._upload_queue.shutdown(timeout=self._settings.get_int(["upload_shutdown_timeout"]))
+        if self._upload_journal is not None:
+            self._upload_journal.close()
+        if self._content_index is not None:
+            self._content_index.close()
+        self._dav_clients.reset()
 
     ##~~ SettingsPlugin mixin
     def get_settings_defaults(self):
@@ -43,7 +215,52 @@ class WebDavBackupPlugin(octoprint.plugin.SettingsPlugin,
             upload_other_path=None,
             upload_other_filter="*.gcode,*.stl",
             upload_other_overwrite=True,
+            upload_other_skip_unchanged=True,
+            upload_other_min_size=0, # KB
+            upload_other_max_size=0, # MB
+            upload_other_max_age=0, # days
+            compress_uploads=False,
+            compress_filter="*.gcode",
+            compress_format="gzip",
             remove_after_upload=False,
+            upload_workers=2,
+            upload_queue_size=32,
+            upload_shutdown_timeout=30,
+            retry_max_attempts=10,
+            retry_delay=30,
+            retry_max_delay=3600,
+            chunked_upload=True,
+            chunk_size=10, # MB
+            connection_pool_size=4,
+            connection_idle_timeout=60,
+            directory_cache_ttl=3600,
+            free_space_refresh=600,
+            rate_limit_printing=0, # KB/s, 0 is unlimited
+            rate_limit_idle=0,
+            defer_while_printing=False,
+            defer_timelapse=False,
+            targets=[],
+            retention_backup_keep_last=0,
+            retention_backup_keep_daily=0,
+            retention_backup_keep_weekly=0,
+            retention_backup_keep_monthly=0,
+            retention_backup_max_size=0, # MB
+            retention_timelapse_keep_last=0,
+            retention_timelapse_keep_daily=0,
+            retention_timelapse_keep_weekly=0,
+            retention_timelapse_keep_monthly=0,
+            retention_timelapse_max_size=0,
+            retention_interval=0, # hours, 0 only applies retention after uploads
+            retention_batch_size=20,
+            sync_interval=0, # hours, 0 only syncs when asked to
+            backup_interval=0, # hours, 0 only streams a backup when asked to
+            backup_exclude_uploads=False,
+            backup_exclude_timelapse=False,
+            snapshot_batch=False, # These will not be visible in settings either
+            snapshot_batch_size=20,
+            snapshot_batch_window=30,
+            snapshot_batch_parallel=4,
+            snapshot_batch_tar=False,
         )
         return settings_defaults
 
@@ -54,61 +271,142 @@ class WebDavBackupPlugin(octoprint.plugin.SettingsPlugin,
 
     def on_settings_save(self, data):
         octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
+        self._configure_rate_limits()
+        self._configure_filters()
+        # Only rebuild the WebDAV client if the connection settings actually changed
+        self._dav_clients.configure(
+            self._settings.get_int(["connection_pool_size"]),
+            self._settings.get_int(["connection_idle_timeout"]),
+        )
+        self._dav_clients.retain([(self._get_davoptions(target), target["verify_certificate"]) for target in self._get_targets()])
+        # Paths or servers may have changed, so start over with the directory checks
+        self._dav_dirs.set_ttl(self._settings.get_int(["directory_cache_ttl"]))
+        self._dav_dirs.clear()
+        self._dav_free.set_refresh_interval(self._settings.get_int(["free_space_refresh"]))
+        self._dav_free.invalidate()
+        self._snapshot_batcher.configure(
+            self._settings.get_int(["snapshot_batch_size"]),
+            self._settings.get_int(["snapshot_batch_window"]),
+        )
+        if self._upload_queue is not None:
+            self._upload_queue.set_workers(self._settings.get_int(["upload_workers"]))
+            self._upload_queue.set_retry(
+                self._settings.get_int(["retry_max_attempts"]),
+                self._settings.get_int(["retry_delay"]),
+                self._settings.get_int(["retry_max_delay"]),
+            )
+            # Uploads may no longer have to wait for the print to finish
+            self._upload_queue.release()
+        self._schedule_retention()
+        self._schedule_sync()
+        self._schedule_backup()
+
+    def _configure_rate_limits(self):
+        # Read once here, the rate is looked up for every block that is sent
+        self._rate_limits = (
+            self._settings.get_int(["rate_limit_printing"]) or 0,
+            self._settings.get_int(["rate_limit_idle"]) or 0,
+        )
+
+    def _configure_filters(self):
+        # Compiled once here instead of for every file that is added
+        min_size = (self._settings.get_int(["upload_other_min_size"]) or 0) * 1024
+        max_size = (self._settings.get_int(["upload_other_max_size"]) or 0) * 1024 * 1024
+        max_age = (self._settings.get_int(["upload_other_max_age"]) or 0) * 24 * 3600
+        self._file_filters = OrderedDict(
+            # If no filter is set, only upload gcode and stl files
+            (target["name"], FileFilter(target["upload_other_filter"] or "*.gcode,*.stl", min_size, max_size, max_age))
+            for target in self._get_targets()
+        )
+        compress_filter = self._settings.get(["compress_filter"])
+        self._compress_filter = FileFilter(compress_filter) if compress_filter else None
+
+    def _accept_file_added(self, payload):
+        # Cheap checks first, bulk imports add thousands of files at once
+        if not self._settings.get(["upload_other"]) or payload.get("storage") != "local":
+            return False
+        relative_path = payload["path"]
+        file_filters = [file_filter for file_filter in self._file_filters.values() if file_filter.matches(relative_path)]
+        if not file_filters:
+            self._logger.debug("Local file " + relative_path + " does not match any filter, will NOT upload")
+            return False
+        if any(file_filter.needs_stat for file_filter in file_filters):
+            try:
+                file_stat = osstat(ospath.join(self._settings.getBaseFolder("uploads"), relative_path))
+            except OSError:
+                return False
+            if not any(file_filter.check(file_stat) for file_filter in file_filters):
+                self._logger.info("Local file " + relative_path + " is too small, too large or too old, will NOT upload")
+                return False
+        return True
+
+    def _is_printing(self):
+        return self._printer is not None and self._printer.is_printing()
+
+    def _current_rate(self):
+        rate_limit_printing, rate_limit_idle = self._rate_limits
+        rate_limit = rate_limit_printing if self._is_printing() else rate_limit_idle
+        return rate_limit * 1024
+
+    def _hold_upload(self, job):
+        # Backups and other files can wait until the print is done, snapshots never do
+        if job.event == "MovieDone":
+            defer = self._settings.get_boolean(["defer_timelapse"])
+        elif job.event in ("FileAdded", "plugin_backup_backup_created"):
+            defer = self._settings.get_boolean(["defer_while_printing"])
+        else:
+            defer = False
+        return defer and self._is_printing()
 
     ##~~ EventHandlerPlugin mixin
     def on_event(self, event, payload):
+        if event in ("PrintDone", "PrintFailed", "PrintCancelled"):
+            # No more snapshots will follow, don't wait for the batch to fill up
+            self._snapshot_batcher.flush()
+            # Uploads held back during the print can go now, even though the printer is still finishing or cancelling
+            self._upload_queue.release(force=True)
+            if self._backup_status["deferred"]:
+                self._start_backup(force=True)
+
+        if event == "FileAdded" and not self._accept_file_added(payload):
+            return
+
+        job = self._create_upload_job(event, payload)
+        if job is None:
+            return
+
+        if event == "CaptureDone" and self._settings.get_boolean(["snapshot_batch"]):
+            self._snapshot_batcher.add(job)
+            return
+
+        # The actual upload happens on one of the upload workers, never on the event thread
+        self._upload_queue.enqueue(job)
+
+    def _create_upload_job(self, event, payload, now=None):
         upload_timelapse_video = self._settings.get(["upload_timelapse_video"])
         upload_timelapse_snapshots = self._settings.get(["upload_timelapse_snapshots"])
         upload_other = self._settings.get(["upload_other"])
         remove_after_upload = self._settings.get(["remove_after_upload"])
 
         if event == "plugin_backup_backup_created" or (event == "MovieDone" and upload_timelapse_video) or (event == "CaptureDone" and upload_timelapse_snapshots) or (event == "FileAdded" and upload_other):
-            # Helper function for human readable sizes
-            def _convert_size(size_bytes):
-                if size_bytes == 0:
-                    return "0B"
-                size_name = ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")
-                i = int(math.floor(math.log(size_bytes, 1024)))
-                p = math.pow(1024, i)
-                s = round(size_bytes / p, 2)
-                return "%s %s" % (s, size_name[i])
-
-            now = datetime.now()
-
-            davoptions = {
-                'webdav_hostname': self._settings.get(["server"]),
-                'webdav_login':    self._settings.get(["username"]),
-                'webdav_password': self._settings.get(["password"]),
-                'webdav_timeout': self._settings.get(["timeout"]),
-                'disable_check': self._settings.get(["disable_path_check"]),
-            }
+            # Files found by a sync are stored by the date they were created, not the date they were found
+            now = now or datetime.now()
+            server = self._settings.get(["server"])
 
             # Set a safe default here
             upload_overwrite = False
+            # Only set for files in the uploads folder, used to match the filters
+            relative_path = None
 
             if event == "plugin_backup_backup_created":
                 local_file_path = payload["path"]
                 local_file_name = payload["name"]
-                self._logger.info("Backup " + local_file_path + " created, will now attempt to upload to " + davoptions["webdav_hostname"])
-                if self._settings.get(["upload_name"]):
-                    upload_name = now.strftime(self._settings.get(["upload_name"])) + ospath.splitext(local_file_path)[-1]
-                else:
-                    upload_name = local_file_name
-                upload_path = now.strftime(self._settings.get(["upload_path"]))
+                self._logger.info("Backup " + local_file_path + " created, will now attempt to upload to " + server)
 
             elif event == "MovieDone":
                 local_file_path = payload["movie"]
                 local_file_name = payload["movie_basename"]
-                self._logger.info("Timelapse movie " + local_file_path + " created, will now attempt to upload to " + davoptions["webdav_hostname"])
-                if self._settings.get(["upload_timelapse_name"]):
-                    upload_name = now.strftime(self._settings.get(["upload_timelapse_name"])) + local_file_name
-                else:
-                    upload_name = local_file_name
-                if self._settings.get(["upload_timelapse_path"]):
-                    upload_path = now.strftime(self._settings.get(["upload_timelapse_path"]))
-                else:
-                    # If no specific path is set for timelapses, upload them to the same directory as the backups
-                    upload_path = now.strftime(self._settings.get(["upload_path"]))
+                self._logger.info("Timelapse movie " + local_file_path + " created, will now attempt to upload to " + server)
 
             elif event == "CaptureDone":
                 # Removing snapshots makes it hard to create a timelapse
@@ -116,16 +414,7 @@ class WebDavBackupPlugin(octoprint.plugin.SettingsPlugin,
 
                 local_file_path = payload["file"]
                 local_file_name = ospath.split(local_file_path)[1]
-                self._logger.info("Timelapse snapshot " + local_file_path + " created, will now attempt to upload to " + davoptions["webdav_hostname"] + " as " + local_file_name)
-                if self._settings.get(["upload_timelapse_name"]):
-                    upload_name = now.strftime(self._settings.get(["upload_timelapse_name"])) + local_file_name
-                else:
-                    upload_name = local_file_name
-                if self._settings.get(["upload_timelapse_path"]):
-                    upload_path = now.strftime(self._settings.get(["upload_timelapse_path"]))
-                else:
-                    # If no specific path is set for timelapses, upload them to the same directory as the backups
-                    upload_path = now.strftime(self._settings.get(["upload_path"]))
+                self._logger.info("Timelapse snapshot " + local_file_path + " created, will now attempt to upload to " + server + " as " + local_file_name)
 
             elif event == "FileAdded":
                 # Removing random files is undesired behavior
@@ -134,167 +423,951 @@ class WebDavBackupPlugin(octoprint.plugin.SettingsPlugin,
                 upload_overwrite = self._settings.get(["upload_other_overwrite"])
 
                 local_file_storage = payload["storage"]
-                local_file_path = payload["path"]
+                relative_path = payload["path"]
                 local_file_name = payload["name"]
                 local_file_type = payload["type"]
                 _local_storage = self._settings.getBaseFolder("uploads")
                 self._logger.debug(f"Upload folder: {_local_storage}")
+                self._logger.debug("File " + relative_path + " was created on storage " + local_file_storage)
+                local_file_path = ospath.join(_local_storage, relative_path)
+                self._logger.debug(local_file_type)
 
-                if self._settings.get(["upload_other_filter"]):
-                    other_file_filter = self._settings.get(["upload_other_filter"]).lower().split(',')
-                else:
-                    # If no specific path is set for timelapses, upload them to the same directory as the backups
-                    other_file_filter = ["*.gcode","*.stl"]
-
-                _file_match = False
-                for pattern in other_file_filter:
-                    if fn(ospath.join('/', local_file_path.lower()), ospath.join('/', pattern.strip())):
-                        self._logger.info("Local file " + local_file_path + " matches " + pattern + ", will upload")
-                        _file_match = True
-                        break
-                    else:
-                        self._logger.debug("Local file " + local_file_path + " doesn't match " + pattern)
-
-                if not _file_match:
-                    self._logger.info("Local file " + local_file_path + " does not match any pattern, will NOT upload")
-                    return
-
-                if self._settings.get(["upload_other_path"]):
-                    upload_path = now.strftime(self._settings.get(["upload_other_path"]))
-                else:
-                    # If no specific path is set for timelapses, upload them to the same directory as the backups
-                    upload_path = now.strftime(self._settings.get(["upload_path"]))
+            # Every target has its own paths and filters
+            destinations = OrderedDict()
+            for target in self._get_targets():
+                destination = self._get_destination(event, target, now, local_file_name, relative_path)
+                if destination is not None:
+                    destinations[target["name"]] = destination
+            if not destinations:
+                return None
+            primary = next(iter(destinations.values()))
 
-                if self._settings.get(["upload_other_full_path"]):
-                    upload_path = ospath.join(upload_path, ospath.dirname(local_file_path))
+            return UploadJob(
+                event=event,
+                local_file_path=local_file_path,
+                upload_path=primary["upload_path"],
+                upload_name=primary["upload_name"],
+                overwrite=upload_overwrite,
+                remove_after_upload=remove_after_upload,
+                priority=_UPLOAD_PRIORITIES.get(event, 1),
+                targets=destinations,
+                relative_path=relative_path,
+            )
+
+        return None
+
+    def _get_destination(self, event, target, now, local_file_name, relative_path=None):
+        if event == "plugin_backup_backup_created":
+            if target["upload_name"]:
+                upload_name = now.strftime(target["upload_name"]) + ospath.splitext(local_file_name)[-1]
+            else:
                 upload_name = local_file_name
-                self._logger.debug("File " + local_file_path + " was created on storage " + local_file_storage + ", will upload to " + ospath.join(upload_path, upload_name))
-                local_file_path = ospath.join(_local_storage, local_file_path)
-                self._logger.debug(local_file_type)
+            upload_path = now.strftime(target["upload_path"])
+
+        elif event in ("MovieDone", "CaptureDone"):
+            if target["upload_timelapse_name"]:
+                upload_name = now.strftime(target["upload_timelapse_name"]) + local_file_name
+            else:
+                upload_name = local_file_name
+            if target["upload_timelapse_path"]:
+                upload_path = now.strftime(target["upload_timelapse_path"])
+            else:
+                # If no specific path is set for timelapses, upload them to the same directory as the backups
+                upload_path = now.strftime(target["upload_path"])
+
+        elif event == "FileAdded":
+            file_filter = self._file_filters.get(target["name"])
+            if file_filter is None or not file_filter.matches(relative_path):
+                self._logger.debug("Local file " + relative_path + " does not match the filter of " + target["name"] + ", will NOT upload there")
+                return None
+            self._logger.info("Local file " + relative_path + " matches the filter of " + target["name"] + ", will upload")
+
+            if target["upload_other_path"]:
+                upload_path = now.strftime(target["upload_other_path"])
+            else:
+                # If no specific path is set for timelapses, upload them to the same directory as the backups
+                upload_path = now.strftime(target["upload_path"])
+
+            if target["upload_other_full_path"]:
+                upload_path = ospath.join(upload_path, ospath.dirname(relative_path))
+            upload_name = local_file_name
+            self._logger.debug("File " + relative_path + " will be uploaded to " + target["name"] + " as " + ospath.join(upload_path, upload_name))
+
+        return dict(upload_path=upload_path, upload_name=upload_name, required=target["required"])
+
+    ##~~ Upload targets
+    def _get_targets(self):
+        # The top level settings are the primary target, additional targets fall back to its paths and filters
+        primary = dict((key, self._settings.get([key])) for key in _TARGET_SETTINGS)
+        primary.update(name="primary", required=True)
+        targets = [primary]
+        names = set([primary["name"]])
+        for index, settings in enumerate(self._settings.get(["targets"]) or []):
+            if not settings.get("server"):
+                continue
+            # Never send the credentials of one server to another
+            target = dict(primary, server=None, username=None, password=None, required=True)
+            target.update((key, value) for key, value in settings.items() if value is not None and value != "")
+            if not target.get("name") or target["name"] in names:
+                target["name"] = (target.get("name") or "target") + "_" + str(index + 1)
+            names.add(target["name"])
+            targets.append(target)
+        return targets
+
+    def _get_pending_targets(self, job):
+        targets = OrderedDict((target["name"], target) for target in self._get_targets())
+        if not job.targets:
+            # Jobs from before there were multiple targets only go to the primary server
+            return [(targets["primary"], dict(upload_path=job.upload_path, upload_name=job.upload_name, required=True))]
+        pending = []
+        for name, destination in job.targets.items():
+            if name in job.completed:
+                continue
+            if name not in targets:
+                self._logger.warning("Target " + name + " is no longer configured, will NOT upload " + job.local_file_path + " there")
+                continue
+            pending.append((targets[name], destination))
+        return pending
+
+    ##~~ Upload worker
+    def _get_davoptions(self, target=None):
+        if target is None:
+            target = self._get_targets()[0]
+        return {
+            'webdav_hostname': target["server"],
+            'webdav_login':    target["username"],
+            'webdav_password': target["password"],
+            'webdav_timeout': target["timeout"],
+            'disable_check': target["disable_path_check"],
+        }
+
+    def _get_target_upload(self, target, destination, upload_name=None):
+        # Everything needed to upload to a single target, and the outcome
+        davoptions = self._get_davoptions(target)
+        upload_path = ospath.join("/", destination["upload_path"])
+        upload_name = upload_name or destination["upload_name"]
+        upload_file = ospath.join("/", upload_path, upload_name) if upload_name else None
+        client = self._dav_clients.get(davoptions, verify=target["verify_certificate"])
+        return dict(
+            name=target["name"],
+            required=destination.get("required", True),
+            target=target,
+            davoptions=davoptions,
+            # The caches are keyed on the client's hostname, which has no trailing slash
+            hostname=client.webdav.hostname,
+            client=client,
+            upload_path=upload_path,
+            upload_file=upload_file,
+            upload_temp=upload_file + ".tmp" if upload_file else None,
+            remote_size=None,
+            done=False,
+            error=None,
+            retry=True,
+        )
+
+    def _upload_snapshot_batch(self, upload_path, files):
+        if self._settings.get_boolean(["snapshot_batch_tar"]):
+            # Snapshot names restart with every print, so add the date to keep them apart
+            upload_name = datetime.now().strftime("snapshots_%Y%m%d%H%M%S_") + ospath.splitext(files[0][1])[0] + "-" + ospath.splitext(files[-1][1])[0] + ".tar"
+        else:
+            upload_name = None
+
+        # The batch was collected for the primary path, the other targets get their own
+        now = datetime.now()
+        destinations = OrderedDict()
+        for target in self._get_targets():
+            destination = self._get_destination("CaptureDone", target, now, upload_name or "")
+            destination["upload_name"] = upload_name
+            destinations[target["name"]] = destination
+        destinations["primary"]["upload_path"] = upload_path
+
+        job = UploadJob(
+            event="CaptureDone",
+            local_file_path=files[0][0],
+            upload_path=upload_path,
+            upload_name=upload_name,
+            files=files,
+            targets=destinations,
+        )
+        self._upload_queue.enqueue(job)
+
+    def _process_snapshot_batch(self, job):
+        # Snapshots are removed once the timelapse has been rendered
+        files = [(local_file_path, name) for local_file_path, name in job.files if ospath.exists(local_file_path)]
+        if len(files) < len(job.files):
+            self._logger.warning(str(len(job.files) - len(files)) + " snapshots were removed before they could be uploaded")
+        if not files:
+            return True
+
+        uploads = [self._get_target_upload(target, destination) for target, destination in self._get_pending_targets(job)]
+        for upload in uploads:
+            failed = self._upload_snapshots(job, upload, files)
+            if failed and len(uploads) == 1:
+                # Only the snapshots that failed are sent again on the next attempt
+                job.files = failed
+                self._save_progress(job)
+        return self._finish_targets(job, uploads)
+
+    def _upload_snapshots(self, job, upload, files):
+        davclient = upload["client"]
+        upload_path = upload["upload_path"]
+        try:
+            with self._metrics.phase("mkdir"):
+                path_ok = upload["target"]["disable_path_check"] or self._dav_dirs.ensure(davclient, upload_path)
+            if not path_ok:
+                upload["error"] = "Something went wrong trying to check/create the upload path."
+                self._logger.error(upload["error"])
+                return None
+
+            # Snapshots are small, so they go straight to their final name without a temporary file
+            if upload["upload_file"]:
+                self._logger.debug("Uploading " + str(len(files)) + " snapshots to " + upload["upload_file"])
+                stream = IterStream(tar_stream(files), tar_size(files))
+                with self._metrics.phase("put"):
+                    dav_upload_stream(davclient, upload["upload_file"], stream)
+                self._metrics.add_bytes(stream.bytes_read)
+                failed = []
+            else:
+                self._logger.debug("Uploading " + str(len(files)) + " snapshots to " + upload_path)
+                failed = []
+                with self._metrics.phase("put"), ThreadPoolExecutor(max_workers=self._settings.get_int(["snapshot_batch_parallel"])) as executor:
+                    futures = dict(
+                        (executor.submit(dav_upload_file, davclient, ospath.join(upload_path, name), local_file_path), (local_file_path, name))
+                        for local_file_path, name in files
+                    )
+                    for future in as_completed(futures):
+                        try:
+                            future.result()
+                            self._metrics.add_bytes(osstat(futures[future][0]).st_size)
+                        except Exception as exception:
+                            self._logger.debug("Uploading snapshot " + futures[future][0] + " failed: " + str(exception))
+                            failed.append(futures[future])
+        except ResponseErrorCode as exception:
+            if exception.code == 409:
+                self._dav_dirs.invalidate(upload["hostname"], upload_path)
+            upload["error"] = _http_error(exception)
+            upload["retry"] = _is_transient(exception.code) or exception.code == 409
+            self._logger.error(upload["error"])
+            return None
+
+        if failed:
+            self._dav_dirs.invalidate(upload["hostname"], upload_path)
+            upload["error"] = str(len(failed)) + " of " + str(len(files)) + " snapshots could not be uploaded."
+            self._logger.error(upload["error"])
+            return failed
+
+        upload["done"] = True
+        self._logger.info(str(len(files)) + " timelapse snapshots have been uploaded successfully to " + upload["hostname"] + " in " + upload_path)
+        return None
+
+    def _process_upload(self, job):
+        # Every attempt is timed, so it shows up in the statistics
+        if job.files:
+            name = str(len(job.files)) + " snapshots"
+            paths = [local_file_path for local_file_path, file_name in job.files]
+        else:
+            name = job.upload_name
+            paths = [job.local_file_path]
+        self._metrics.begin(name, sum(osstat(local_file_path).st_size for local_file_path in paths if ospath.exists(local_file_path)))
+        success = False
+        try:
+            success = self._upload(job)
+        finally:
+            self._metrics.end(success, job.error)
+        if success and job.event in _RETENTION_KINDS:
+            # Make room for the next one right away
+            self._apply_retention([_RETENTION_KINDS[job.event]])
+        return success
+
+    def _upload(self, job):
+        if job.files:
+            return self._process_snapshot_batch(job)
 
-            davclient = Client(davoptions)
-            davclient.verify = self._settings.get(["verify_certificate"])
-            check_space = self._settings.get(["check_space"])
-            skip_path_check = self._settings.get(["disable_path_check"])
-            upload_path = ospath.join("/", upload_path)
-
-            self._logger.debug("Filename for upload: " + upload_name)
-
-            upload_file = ospath.join("/", upload_path, upload_name)
-            upload_temp = ospath.join("/", upload_file + ".tmp")
-
-            self._logger.debug("Upload location: " + upload_file)
-
-            # Check actual connection to the WebDAV server as the check command will not do this.
-            if check_space:
-                self._logger.debug("Attempting to check free space.")
-                try:
-                    # If the resource was not found
-                    dav_free = davclient.free()
-                    if dav_free < 0:
-                        # If we get a negative free size, this server is not returning correct value.
-                        check_space = False
-                        self._logger.warning("Free space on server: " + str(dav_free) + ", it appears your server does not support reporting size correctly but it's still a proper way to check connectivity.")
-                    else:
-                        self._logger.info("Free space on server: " + _convert_size(dav_free))
-                except RemoteResourceNotFound as exception:
-                    self._logger.error("Resource was not found, something is probably wrong with your settings.")
-                    return
-                except ResponseErrorCode as exception:
-                    # Write error and exit function
-                    status = HTTPStatus(exception.code)
-                    error_switcher = {
-                        400: "Bad request",
-                        401: "Unauthorized",
-                        403: "Forbidden",
-                        404: "Not found",
-                        405: "Method not allowed",
-                        408: "Request timeout",
-                        500: "Internal error",
-                        501: "Not implemented",
-                        502: "Bad gateway",
-                        503: "Service unavailable",
-                        504: "Gateway timeout",
-                        508: "Loop detected",
-                    }
-                    if (exception.code == 401):
-                        http_error = "HTTP error 401 encountered, your credentials are most likely wrong."
-                    else:
-                        http_error = "HTTP error encountered: " + str(status.value) + " " + error_switcher.get(exception.code, status.phrase)
-                    self._logger.error(http_error)
-                    return
-                except WebDavException as exception:
-                    self._logger.error("An unexpected WebDAV error was encountered: " + exception.args)
-                    raise
-            elif not skip_path_check:
-                self._logger.debug("Not checking free space, just try to check the WebDAV root.")
-                # Not as proper of a check as retrieving size, but it's something.
-                if davclient.check("/"):
-                    self._logger.debug("Server returned WebDAV root.")
+        local_file_path = job.local_file_path
+
+        compression = self._get_compression(job)
+        upload_name = job.upload_name
+        if compression:
+            upload_name += COMPRESSION_SUFFIXES[compression]
+        self._logger.debug("Filename for upload: " + upload_name)
+
+        try:
+            local_file_size = ospath.getsize(local_file_path)
+            self._logger.info("File size: " + _convert_size(local_file_size))
+        except FileNotFoundError:
+            job.error = f"File {local_file_path} not found, this is a known issue when moving a file."
+            job.retry = False
+            self._logger.warning(job.error)
+            return False
+
+        uploads = []
+        for target, destination in self._get_pending_targets(job):
+            upload_name = destination["upload_name"] + (COMPRESSION_SUFFIXES[compression] if compression else "")
+            uploads.append(self._get_target_upload(target, destination, upload_name))
+
+        # Everything that can go wrong before sending the file is checked per target first
+        content = dict()
+        sending = []
+        for upload in uploads:
+            self._logger.debug("Upload location: " + upload["hostname"] + upload["upload_file"])
+            try:
+                if not self._check_target(job, upload, local_file_size):
+                    continue
+                if self._skip_unchanged(job, upload, local_file_size, content):
+                    upload["done"] = True
+                    continue
+                sending.append(upload)
+            except Exception as exception:
+                self._target_error(job, upload, exception)
+
+        if sending:
+            with self._metrics.phase("put"):
+                self._send_file(job, sending, local_file_size, compression)
+        for upload in sending:
+            if upload["error"] is not None:
+                continue
+            try:
+                if compression and not self._verify_upload(upload):
+                    continue
+                self._metrics.add_bytes(upload["remote_size"])
+                self._logger.debug("Moving " + upload["upload_temp"] + " to " + upload["upload_file"])
+                with self._metrics.phase("move"):
+                    dav_move(upload["client"], upload["upload_temp"], upload["upload_file"], overwrite=job.overwrite)
+                self._logger.info("File has been uploaded successfully to " + upload["hostname"] + " as " + upload["upload_file"])
+                upload["done"] = True
+
+                self._dav_free.consume(upload["hostname"], upload["remote_size"])
+                if content.get("sha256") is not None:
+                    self._content_index.add(upload["hostname"], upload["upload_file"], content["sha256"], local_file_size, remote_size=upload["remote_size"])
+            except Exception as exception:
+                self._target_error(job, upload, exception)
+
+        if not self._finish_targets(job, uploads):
+            return False
+
+        if job.remove_after_upload:
+            self._logger.debug("Removing local file after successful upload has been enabled.")
+            try:
+                osremove(local_file_path)
+            except OSError:
+                self._logger.exception("Unable to remove " + local_file_path + " after it was uploaded")
+        job.offset = 0
+        return True
+
+    def _check_target(self, job, upload, local_file_size):
+        davclient = upload["client"]
+        hostname = upload["hostname"]
+        check_space = upload["target"]["check_space"]
+        skip_path_check = upload["target"]["disable_path_check"]
+
+        # Check actual connection to the WebDAV server as the check command will not do this.
+        if check_space:
+            self._logger.debug("Attempting to check free space.")
+            try:
+                # If the resource was not found
+                with self._metrics.phase("free"):
+                    dav_free = self._dav_free.get(davclient, local_file_size)
+                if dav_free < 0:
+                    # If we get a negative free size, this server is not returning correct value.
+                    check_space = False
+                    self._logger.warning("Free space on server: " + str(dav_free) + ", it appears your server does not support reporting size correctly but it's still a proper way to check connectivity.")
                 else:
-                    self._logger.error("Server did not return WebDAV root, something is probably wrong with your settings.")
-                    return
+                    self._logger.info("Free space on server: " + _convert_size(dav_free))
+            except RemoteResourceNotFound as exception:
+                upload["error"] = "Resource was not found, something is probably wrong with your settings."
+                upload["retry"] = False
+                self._logger.error(upload["error"])
+                return False
+            except ResponseErrorCode as exception:
+                # Write error and exit function
+                upload["error"] = _http_error(exception)
+                upload["retry"] = _is_transient(exception.code)
+                self._logger.error(upload["error"])
+                return False
+            except WebDavException as exception:
+                upload["error"] = "An unexpected WebDAV error was encountered: " + str(exception)
+                self._logger.error(upload["error"])
+                return False
+        elif skip_path_check:
+            self._logger.warning("All checks for successful connection are disabled.")
+        elif self._dav_dirs.known(hostname, "/"):
+            self._logger.debug("WebDAV root was found recently, not checking again.")
+        else:
+            self._logger.debug("Not checking free space, just try to check the WebDAV root.")
+            # Not as proper of a check as retrieving size, but it's something.
+            with self._metrics.phase("check"):
+                root_found = davclient.check("/")
+            if root_found:
+                self._logger.debug("Server returned WebDAV root.")
+                self._dav_dirs.add(hostname, "/")
             else:
-                self._logger.warning("All checks for successful connection are disabled.")
+                upload["error"] = "Server did not return WebDAV root, something is probably wrong with your settings."
+                self._logger.error(upload["error"])
+                return False
+
+        if check_space and (local_file_size > dav_free):
+            upload["error"] = "Unable to upload, size is " + _convert_size(local_file_size) + ", free space is " + _convert_size(dav_free)
+            self._logger.error(upload["error"])
+            return False
+
+        # With the path check disabled, directories have to be created manually
+        with self._metrics.phase("mkdir"):
+            path_ok = skip_path_check or self._dav_dirs.ensure(davclient, upload["upload_path"])
+        if not path_ok:
+            upload["error"] = "Something went wrong trying to check/create the upload path."
+            self._logger.error(upload["error"])
+            return False
+        return True
+
+    def _skip_unchanged(self, job, upload, local_file_size, content):
+        if job.event != "FileAdded" or not self._settings.get_boolean(["upload_other_skip_unchanged"]):
+            return False
+        try:
+            with self._metrics.phase("dedupe"):
+                # Hashed only once, no matter how many targets there are
+                if "sha256" not in content:
+                    content["sha256"] = file_sha256(job.local_file_path)
+                return self._reuse_uploaded_content(upload["client"], job, upload["upload_file"], content["sha256"], local_file_size)
+        except ResponseErrorCode as exception:
+            self._logger.warning("Unable to check for unchanged content, uploading anyway: " + _http_error(exception))
+        except (WebDavException, requests.RequestException, OSError) as exception:
+            # E.g. a server without COPY, a locked file or a connection problem, the upload itself may still work
+            self._logger.warning("Unable to check for unchanged content, uploading anyway: " + str(exception))
+        return False
+
+    def _send_file(self, job, uploads, local_file_size, compression):
+        chunk_size = self._settings.get_int(["chunk_size"]) * 1024 * 1024
+        chunked = not compression and self._settings.get_boolean(["chunked_upload"]) and local_file_size > chunk_size
+
+        if len(uploads) > 1 and not chunked:
+            # Read the file once and send it to all targets at the same time
+            self._logger.debug("Uploading " + job.local_file_path + " to " + str(len(uploads)) + " targets at once")
+            source = compress_stream(job.local_file_path, compression) if compression else read_file(job.local_file_path)
+            self._send_stream(job, uploads, source, None if compression else local_file_size)
+            return
 
+        # Chunked uploads read their own parts of the file, so they can be resumed per target
+        def send(upload):
+            self._logger.debug("Uploading " + job.local_file_path + " to " + upload["upload_temp"])
             try:
-                local_file_size = ospath.getsize(local_file_path)
-                self._logger.info("File size: " + _convert_size(local_file_size))
-            except FileNotFoundError:
-                self._logger.warning(f"File {local_file_path} not found, this is a known issue when moving a file.")
-                return
-
-            if check_space and (local_file_size > dav_free):
-                self._logger.error("Unable to upload, size is" + _convert_size(local_file_size) + ", free space is " + _convert_size(dav_free))
-                return
+                if compression:
+                    # The compressed size isn't known up front, so this can't be sent in chunks
+                    stream = IterStream(compress_stream(job.local_file_path, compression))
+                    dav_upload_stream(upload["client"], upload["upload_temp"], stream)
+                    upload["remote_size"] = stream.bytes_read
+                    self._logger.debug("Compressed " + _convert_size(local_file_size) + " to " + _convert_size(upload["remote_size"]) + " using " + compression)
+                elif chunked:
+                    # Large files are sent in chunks, so an interrupted upload can be resumed
+                    chunked_upload = ChunkedUpload(upload["client"], chunk_size, self._server_capabilities, progress=self._save_progress)
+                    chunked_upload.upload(job, job.local_file_path, upload["upload_temp"])
+                    upload["remote_size"] = local_file_size
+                else:
+                    dav_upload_file(upload["client"], upload["upload_temp"], job.local_file_path)
+                    upload["remote_size"] = local_file_size
+            except Exception as exception:
+                self._target_error(job, upload, exception)
+
+        if len(uploads) == 1:
+            send(uploads[0])
+            return
+        with ThreadPoolExecutor(max_workers=len(uploads)) as executor:
+            for future in [executor.submit(send, upload) for upload in uploads]:
+                future.result()
+
+    def _send_stream(self, job, uploads, source, length=None):
+        # Sends a generator of bytes to every target, without a length it goes out as a chunked transfer
+        tee = Tee(source, len(uploads)) if len(uploads) > 1 else None
+
+        def send(upload):
+            index = uploads.index(upload)
+            stream = IterStream(tee.stream(index) if tee else source, length)
+            try:
+                dav_upload_stream(upload["client"], upload["upload_temp"], stream)
+                upload["remote_size"] = stream.bytes_read
+            except Exception as exception:
+                self._target_error(job, upload, exception)
+            finally:
+                if tee:
+                    tee.close(index)
+
+        if tee is None:
+            send(uploads[0])
+            return
+        with ThreadPoolExecutor(max_workers=len(uploads)) as executor:
+            futures = [executor.submit(send, upload) for upload in uploads]
+            tee.run()
+            for future in futures:
+                future.result()
+
+    def _verify_upload(self, upload):
+        # Some servers silently store an empty file for a chunked transfer, check the size before moving it into place
+        with self._metrics.phase("verify"):
+            remote = dav_properties(upload["client"], upload["upload_temp"])
+        if remote is not None and remote["size"] == upload["remote_size"]:
+            return True
+        upload["error"] = "The upload on the server is incomplete, " + _convert_size(upload["remote_size"]) + " was sent but the server reports " + (_convert_size(remote["size"]) if remote is not None and remote["size"] is not None else "no size")
+        self._logger.error(upload["error"])
+        if remote is not None:
+            dav_delete(upload["client"], upload["upload_temp"])
+        return False
+
+    def _target_error(self, job, upload, exception):
+        # Same handling for every target, the outcome is collected by _finish_targets
+        hostname = upload["hostname"]
+        if isinstance(exception, NotEnoughSpace):
+            # Our estimate was off, ask the server again next time
+            self._dav_free.invalidate(hostname)
+            upload["error"] = "Unable to upload, the server is out of space."
+            self._logger.error(upload["error"])
+        elif isinstance(exception, (RemoteParentNotFound, RemoteResourceNotFound)):
+            # The directory has disappeared since we last checked, the next attempt will create it again
+            self._dav_dirs.invalidate(hostname, upload["upload_path"])
+            upload["error"] = "The specified parent directory was not found, unable to upload."
+            self._logger.error(upload["error"])
+        elif isinstance(exception, ResponseErrorCode):
+            if exception.code == 409:
+                self._dav_dirs.invalidate(hostname, upload["upload_path"])
+            upload["error"] = _http_error(exception)
+            upload["retry"] = _is_transient(exception.code) or exception.code == 409
+            self._logger.error(upload["error"])
+        else:
+            if upload["target"]["disable_path_check"]:
+                upload["error"] = "Something went wrong uploading the file. Since you disabled the path check, this could anything, like incorrect credentials or a non-existing directory."
+            elif job.remove_after_upload:
+                upload["error"] = "Something went wrong uploading the file. (local file not removed)"
             else:
-                # Helper function to recursively create paths
-                def _recursive_create_path(path):
-                    # Append leading / for preventing abspath issues
-                    path = ospath.join("/", path)
-                    if davclient.check(path):
-                        self._logger.debug("Directory " + path + " was found.")
-                        return True
-                    else:
-                        if path != "/":
-                            self._logger.debug("Directory " + path + " was not found, checking parent.")
-                            if _recursive_create_path(ospath.abspath(ospath.join(path, ".."))):
-                                davclient.mkdir(path)
-                                self._logger.debug("Directory " + path + " has been created.")
-                                return True
-                        else:
-                            self._logger.error("Could not find WebDAV root, something is probably wrong with your settings.")
-                            return False
-
-                if _recursive_create_path(upload_path):
+                upload["error"] = "Something went wrong uploading the file."
+            self._logger.error(upload["error"], exc_info=exception)
+
+    def _finish_targets(self, job, uploads):
+        # The job is done once every required target has the file, optional targets are not retried
+        failed = []
+        for upload in uploads:
+            if upload["done"]:
+                job.completed.append(upload["name"])
+            elif upload["error"] is not None:
+                failed.append(upload)
+        if len(uploads) > 1:
+            job.error = "; ".join(upload["name"] + ": " + upload["error"] for upload in failed) or None
+        elif failed:
+            job.error = failed[0]["error"]
+
+        required = [upload for upload in failed if upload["required"]]
+        if not required:
+            for upload in failed:
+                self._logger.warning("Giving up on uploading " + job.local_file_path + " to optional target " + upload["name"])
+            return True
+        job.retry = any(upload["retry"] for upload in required)
+        return False
+
+    ##~~ Retention
+    def _schedule_retention(self):
+        if self._retention_timer is not None:
+            self._retention_timer.cancel()
+            self._retention_timer = None
+        interval = self._settings.get_int(["retention_interval"])
+        if interval:
+            self._retention_timer = RepeatedTimer(interval * 3600, self._apply_retention, daemon=True)
+            self._retention_timer.start()
+
+    def _get_retention_policy(self, kind, target):
+        values = [self._settings.get_int(["retention_" + kind + "_" + key]) or 0 for key in ("keep_last", "keep_daily", "keep_weekly", "keep_monthly", "max_size")]
+        if kind == "backup":
+            path_template = target["upload_path"]
+            # Without a filename, backups keep the name OctoPrint gave them
+            name = template_pattern(target["upload_name"]) if target["upload_name"] else "*-backup-*"
+            names = [name + ".zip"]
+        else:
+            path_template = target["upload_timelapse_path"] or target["upload_path"]
+            name = template_pattern(target["upload_timelapse_name"])
+            names = [name + "*" + extension for extension in _TIMELAPSE_EXTENSIONS]
+        # Compressed uploads count as well
+        names += [name + suffix for name in names for suffix in COMPRESSION_SUFFIXES.values()]
+        path_pattern = template_pattern(ospath.join("/", path_template or ""))
+        prefix = static_prefix(path_template)
+        patterns = [ospath.join(path_pattern, name) for name in names]
+        if prefix == "/" and not is_specific(name):
+            # Anything in the root of the server would match, that's not ours to remove
+            if any(values):
+                self._logger.warning("Not applying " + kind + " retention on " + target["name"] + ", set a path or a filename to tell uploads apart from other files on the server")
+            patterns = []
+        policy = RetentionPolicy(patterns, *(values[:4] + [values[4] * 1024 * 1024]))
+        return prefix, policy
+
+    def _apply_retention(self, kinds=None):
+        # Never runs twice at the same time, uploads and the schedule may both trigger it
+        with self._retention_lock:
+            for target in self._get_targets():
+                policies = OrderedDict()
+                for kind in kinds or _RETENTION_KINDS.values():
+                    prefix, policy = self._get_retention_policy(kind, target)
+                    if policy.active():
+                        # Kinds sharing a directory share the listing as well
+                        policies.setdefault(prefix, []).append(policy)
+                if not policies:
+                    continue
+
+                davoptions = self._get_davoptions(target)
+                davclient = self._dav_clients.get(davoptions, verify=target["verify_certificate"])
+                for prefix, prefix_policies in policies.items():
                     try:
-                        self._logger.debug("Uploading " + local_file_path + " to " + upload_temp)
-                        davclient.upload_sync(remote_path=upload_temp, local_path=local_file_path)
-                        self._logger.debug("Moving " + upload_temp + " to " + upload_file)
-                        davclient.move(remote_path_from=upload_temp, remote_path_to=upload_file, overwrite=upload_overwrite)
-                        self._logger.info("File has been uploaded successfully to " + davoptions["webdav_hostname"] + " as " + upload_file)
-
-                        if remove_after_upload:
-                            self._logger.debug("Removing local file after successful upload has been enabled.")
-                            osremove(local_file_path)
-                    except RemoteParentNotFound:
-                        self._logger.error("The specified parent directory was not found, unable to upload.")
-                    except:
-                        if skip_path_check:
-                            self._logger.error("Something went wrong uploading the file. Since you disabled the path check, this could anything, like incorrect credentials or a non-existing directory.")
-                        elif remove_after_upload:
-                            self._logger.error("Something went wrong uploading the file. (local file not removed)")
-                        else:
-                            self._logger.error("Something went wrong uploading the file.")
-                else:
-                    self._logger.error("Something went wrong trying to check/create the upload path.")
+                        deleted = dav_prune(davclient, prefix, prefix_policies, batch_size=self._settings.get_int(["retention_batch_size"]), parallel=self._settings.get_int(["connection_pool_size"]))
+                    except ResponseErrorCode as exception:
+                        self._logger.error("Unable to apply retention below " + prefix + ": " + _http_error(exception))
+                        continue
+                    except Exception:
+                        self._logger.exception("Unable to apply retention below " + prefix)
+                        continue
+                    if deleted:
+                        self._logger.info("Removed " + str(len(deleted)) + " old uploads from " + davoptions["webdav_hostname"] + " below " + prefix)
+                        self._dav_free.invalidate(davclient.webdav.hostname)
+                        for remote_file in deleted:
+                            self._content_index.remove(davclient.webdav.hostname, remote_file)
+
+    def _get_compression(self, job):
+        if not self._settings.get_boolean(["compress_uploads"]):
+            return None
+        # Same as the upload filters, files outside the uploads folder only have their name to go by
+        if self._compress_filter is None or not self._compress_filter.matches(job.relative_path or ospath.basename(job.local_file_path)):
+            return None
+        compression = self._settings.get(["compress_format"])
+        if compression == "zstd" and zstandard is None:
+            self._logger.warning("zstd compression requires the zstandard package, using gzip instead")
+            compression = "gzip"
+        if compression not in COMPRESSION_SUFFIXES:
+            compression = "gzip"
+        return compression
+
+    def _reuse_uploaded_content(self, davclient, job, upload_file, content_sha256, size):
+        hostname = davclient.webdav.hostname
+        for remote_file, etag, remote_size in self._content_index.find(hostname, content_sha256, size):
+            remote = dav_properties(davclient, remote_file)
+            if remote is None or remote["size"] != remote_size:
+                self._content_index.remove(hostname, remote_file)
+                continue
+            # Prefer a checksum from the server, then the ETag we saw before
+            remote_sha256 = [checksum for checksum in remote["checksums"] if checksum.startswith("sha256:")]
+            if remote_sha256:
+                unchanged = "sha256:" + content_sha256 in remote_sha256
+            else:
+                unchanged = etag is None or etag == remote["etag"]
+            if not unchanged:
+                self._content_index.remove(hostname, remote_file)
+                continue
+            if etag is None:
+                self._content_index.add(hostname, remote_file, content_sha256, size, remote["etag"], remote_size=remote_size)
+
+            if remote_file == upload_file:
+                self._logger.info("File " + job.local_file_path + " is unchanged since it was uploaded as " + upload_file + ", skipping upload")
+                return True
+            if not job.overwrite and dav_properties(davclient, upload_file) is not None:
+                return False
+            # Same content under another name, let the server copy it instead of sending it again
+            self._logger.info("File " + job.local_file_path + " was already uploaded as " + remote_file + ", copying it to " + upload_file)
+            dav_copy(davclient, remote_file, upload_file, overwrite=job.overwrite)
+            self._content_index.add(hostname, upload_file, content_sha256, size, remote_size=remote_size)
+            return True
+        return False
+
+    def _save_progress(self, job):
+        self._upload_journal.update(job, JOURNAL_UPLOADING)
+
+    ##~~ Sync
+    def _schedule_sync(self):
+        if self._sync_timer is not None:
+            self._sync_timer.cancel()
+            self._sync_timer = None
+        interval = self._settings.get_int(["sync_interval"])
+        if interval:
+            self._sync_timer = RepeatedTimer(interval * 3600, self._start_sync, daemon=True)
+            self._sync_timer.start()
+
+    def _start_sync(self):
+        with self._sync_lock:
+            if self._sync_thread is not None and self._sync_thread.is_alive():
+                return False
+            self._sync_thread = threading.Thread(target=self._sync, name="webdavbackup.sync", daemon=True)
+            self._sync_thread.start()
+        return True
+
+    def _sync(self):
+        self._sync_status.update(running=True, started=time.time(), finished=None, checked=0, queued=0)
+        try:
+            candidates = self._get_sync_candidates()
+            self._sync_status["checked"] = len(candidates)
+            for target in self._get_targets():
+                self._sync_target(target, candidates)
+            self._sync_status["queued"] = self._enqueue_sync_jobs(candidates)
+        except Exception:
+            self._logger.exception("Something went wrong syncing local files")
+        finally:
+            self._sync_status.update(running=False, finished=time.time())
+        self._logger.info("Sync checked " + str(self._sync_status["checked"]) + " local files, " + str(self._sync_status["queued"]) + " are being uploaded")
+
+    def _get_sync_candidates(self):
+        # An upload job for every local file that would have been uploaded if its event had been handled
+        candidates = []
+        if self._settings.get(["upload_other"]):
+            uploads = self._settings.getBaseFolder("uploads")
+            for relative_path, file_stat in local_files(uploads):
+                payload = dict(storage="local", path=relative_path, name=ospath.basename(relative_path), type=None)
+                if self._accept_file_added(payload):
+                    job = self._create_upload_job("FileAdded", payload, now=datetime.fromtimestamp(file_stat.st_mtime))
+                    if job is not None:
+                        candidates.append((job, file_stat))
+        if self._settings.get(["upload_timelapse_video"]):
+            # Rendered timelapses are in the timelapse folder itself, snapshots are in a subfolder
+            timelapses = self._settings.getBaseFolder("timelapse")
+            for relative_path, file_stat in local_files(timelapses, recursive=False):
+                if relative_path.lower().endswith(_TIMELAPSE_EXTENSIONS):
+                    payload = dict(movie=ospath.join(timelapses, relative_path), movie_basename=relative_path)
+                    job = self._create_upload_job("MovieDone", payload, now=datetime.fromtimestamp(file_stat.st_mtime))
+                    if job is not None:
+                        candidates.append((job, file_stat))
+        return candidates
+
+    def _sync_target(self, target, candidates):
+        # Marks the target as completed for every file it already has, using a single listing per directory
+        name = target["name"]
+        files = []
+        for job, file_stat in candidates:
+            if name in job.targets:
+                compression = self._get_compression(job)
+                destination = job.targets[name]
+                remote_file = ospath.join("/", destination["upload_path"], destination["upload_name"] + (COMPRESSION_SUFFIXES[compression] if compression else ""))
+                files.append((job, file_stat, remote_file, compression))
+        if not files:
+            return
+
+        davoptions = self._get_davoptions(target)
+        davclient = self._dav_clients.get(davoptions, verify=target["verify_certificate"])
+        # Only the directories the files go to, a common prefix is often the root of the whole account
+        remote = OrderedDict()
+        for directory in sorted(set(ospath.dirname(remote_file) for job, file_stat, remote_file, compression in files)):
+            try:
+                remote.update((entry["path"], entry) for entry in dav_list_files(davclient, directory, max_depth=1))
+            except (WebDavException, ResponseErrorCode) as exception:
+                self._logger.error("Unable to list " + directory + " on " + davoptions["webdav_hostname"] + ", skipping it: " + str(exception))
+                remote = None
+                break
+
+        missing = []
+        for job, file_stat, remote_file, compression in files:
+            if remote is not None and is_outdated(remote.get(remote_file), file_stat, compression is not None):
+                missing.append((job, file_stat, remote_file))
+                if remote_file in remote:
+                    # The copy on the server is older than the local file
+                    job.overwrite = True
+            else:
+                job.completed.append(name)
+
+        # Timelapses that retention would remove right away are not worth uploading again
+        policy = self._get_retention_policy("timelapse", target)[1]
+        missing_timelapses = dict((remote_file, job) for job, file_stat, remote_file in missing if job.event == "MovieDone")
+        if missing_timelapses and policy.active():
+            # Outdated remote copies are about to be replaced
+            entries = [entry for entry in remote.values() if entry["path"] not in missing_timelapses] + [
+                dict(path=remote_file, size=file_stat.st_size, modified=datetime.fromtimestamp(file_stat.st_mtime, timezone.utc))
+                for job, file_stat, remote_file in missing if remote_file in missing_timelapses
+            ]
+            for entry in policy.expired(entries):
+                if entry["path"] in missing_timelapses:
+                    missing_timelapses[entry["path"]].completed.append(name)
+        self._logger.debug(str(len(missing)) + " of " + str(len(files)) + " local files are missing on " + davoptions["webdav_hostname"])
+
+    def _enqueue_sync_jobs(self, candidates):
+        queued = 0
+        for job, file_stat in candidates:
+            if all(name in job.completed for name in job.targets):
+                continue
+            # Never more than there are workers, so live events don't have to wait for the whole sync
+            while self._upload_queue.depth() >= max(1, self._settings.get_int(["upload_workers"])):
+                if self._sync_stop.wait(0.5):
+                    return queued
+            if self._upload_queue.enqueue(job, again=True):
+                queued += 1
+        return queued
+
+    ##~~ Streaming backup
+    def _schedule_backup(self):
+        if self._backup_timer is not None:
+            self._backup_timer.cancel()
+            self._backup_timer = None
+        interval = self._settings.get_int(["backup_interval"])
+        if interval:
+            self._backup_timer = RepeatedTimer(interval * 3600, self._start_backup, daemon=True)
+            self._backup_timer.start()
+
+    def _start_backup(self, force=False):
+        with self._backup_lock:
+            if self._backup_thread is not None and self._backup_thread.is_alive():
+                return False
+            # Zipping the basedir shouldn't compete with the print, same as backups created by OctoPrint
+            if not force and self._settings.get_boolean(["defer_while_printing"]) and self._is_printing():
+                if not self._backup_status["deferred"]:
+                    self._logger.info("Deferring backup until the print is done")
+                self._backup_status["deferred"] = True
+                return False
+            self._backup_status["deferred"] = False
+            self._backup_thread = threading.Thread(target=self._stream_backup, name="webdavbackup.backup", daemon=True)
+            self._backup_thread.start()
+        return True
+
+    def _stream_backup(self):
+        # A backup of the basedir zipped straight into the upload, without an archive on local storage first
+        global_settings = settings()
+        name = backup_name(global_settings)
+        exclude = [folder for folder in ("uploads", "timelapse") if self._settings.get_boolean(["backup_exclude_" + folder])]
+        self._backup_status.update(running=True, started=time.time(), finished=None, name=name, size=0, error=None)
+        self._metrics.begin(name, 0)
+        job = None
+        success = False
+        hooks_started = False
+        try:
+            exclude, additional_excludes = backup_excludes(global_settings, self._plugin_manager, exclude, self._logger)
+            backup_hooks(self._plugin_manager, "before_backup", self._logger)
+            hooks_started = True
+            files, contents = backup_contents(global_settings, self._plugin_manager, exclude, additional_excludes)
+            now = datetime.now()
+            destinations = OrderedDict()
+            for target in self._get_targets():
+                destination = self._get_destination("plugin_backup_backup_created", target, now, name)
+                if destination is not None:
+                    destinations[target["name"]] = destination
+            primary = next(iter(destinations.values()))
+            job = UploadJob(
+                event="plugin_backup_backup_created",
+                local_file_path=global_settings._basedir,
+                upload_path=primary["upload_path"],
+                upload_name=primary["upload_name"],
+                targets=destinations,
+            )
+            self._logger.info("Streaming a backup of " + str(len(files)) + " files to " + self._settings.get(["server"]) + " as " + primary["upload_name"])
+            success = self._upload_backup(job, files, contents)
+        except Exception as exception:
+            self._logger.exception("Something went wrong streaming a backup")
+            if job is not None:
+                job.error = str(exception)
+        finally:
+            if hooks_started:
+                # Plugins that paused something for the backup can carry on
+                backup_hooks(self._plugin_manager, "after_backup", self._logger, error=not success)
+            error = job.error if job is not None else "Unable to create the backup."
+            self._metrics.end(success, error)
+            self._backup_status.update(running=False, finished=time.time(), error=None if success else error)
+        if success:
+            self._apply_retention(["backup"])
+
+    def _upload_backup(self, job, files, contents):
+        # The archive is at most as large as the files in it, close enough for the free space check
+        local_size = 0
+        for local_file_path, name in files:
+            try:
+                local_size += osstat(local_file_path).st_size
+            except OSError:
+                pass
+
+        uploads = [self._get_target_upload(target, destination) for target, destination in self._get_pending_targets(job)]
+        sending = []
+        for upload in uploads:
+            try:
+                if self._check_target(job, upload, local_size):
+                    sending.append(upload)
+            except Exception as exception:
+                self._target_error(job, upload, exception)
+
+        if sending:
+            with self._metrics.phase("put"):
+                self._send_stream(job, sending, zip_stream(files, contents))
+        for upload in sending:
+            if upload["error"] is not None:
+                continue
+            try:
+                # Nothing is left locally to try again with, so make sure the server has all of it
+                if not self._verify_upload(upload):
+                    continue
+                self._metrics.add_bytes(upload["remote_size"])
+                self._backup_status["size"] = upload["remote_size"]
+                with self._metrics.phase("move"):
+                    dav_move(upload["client"], upload["upload_temp"], upload["upload_file"], overwrite=job.overwrite)
+                self._logger.info("Backup has been uploaded successfully to " + upload["hostname"] + " as " + upload["upload_file"] + ", " + _convert_size(upload["remote_size"]))
+                upload["done"] = True
+                self._dav_free.consume(upload["hostname"], upload["remote_size"])
+            except Exception as exception:
+                self._target_error(job, upload, exception)
+
+        return self._finish_targets(job, uploads)
+
+    ##~~ SimpleApiPlugin mixin
+    def get_api_commands(self):
+        return dict(
+            sync=[],
+            backup=[],
+        )
+
+    def on_api_command(self, command, data):
+        if command == "sync":
+            # Uploads files to the server, same as changing what gets uploaded in the settings
+            if not Permissions.SETTINGS.can():
+                flask.abort(403)
+            started = self._start_sync()
+            return flask.jsonify(started=started, sync=self._sync_status)
+        if command == "backup":
+            if not self._can_create_backup():
+                flask.abort(403)
+            started = self._start_backup()
+            return flask.jsonify(started=started, backup=self._backup_status)
+
+    def on_api_get(self, request):
+        # Recent uploads list file names and errors, only shown on the settings page
+        if not Permissions.SETTINGS.can():
+            flask.abort(403)
+        status = self._metrics.as_dict(self._queue_status())
+        status["sync"] = self._sync_status
+        status["backup"] = self._backup_status
+        return flask.jsonify(status)
+
+    ##~~ BlueprintPlugin mixin
+    def is_blueprint_csrf_protected(self):
+        return True
+
+    @octoprint.plugin.BlueprintPlugin.route("/metrics", methods=["GET"])
+    def get_metrics(self):
+        # Prometheus text format, scrapers can authenticate with an API key
+        if not Permissions.SETTINGS.can():
+            flask.abort(403)
+        return flask.Response(self._metrics.prometheus(self._queue_status()), mimetype="text/plain; version=0.0.4")
+
+    @staticmethod
+    def _can_create_backup():
+        # Same permission as OctoPrint's own backups, which is missing when the backup plugin is disabled
+        try:
+            return Permissions.PLUGIN_BACKUP_CREATE.can()
+        except UnknownPermission:
+            return Permissions.ADMIN.can()
+
+    def _queue_status(self):
+        if self._upload_queue is None:
+            return None
+        status = self._upload_queue.get_status()
+        status.pop("jobs")
+        return status
+
+    ##~~ AssetPlugin mixin
+    def get_assets(self):
+        return dict(
+            js=["js/webdavbackup.js"],
+        )
 
     ##~~ TemplatePlugin mixin
     def get_template_configs(self):
         return [
             dict(
                 type="settings", custom_bindings=False
-            )
+            ),
+            dict(
+                type="settings", name="WebDAV Backup statistics", template="webdavbackup_statistics.jinja2", suffix="_statistics", custom_bindings=True
+            ),
         ]
 
     ##~~ Softwareupdate hook
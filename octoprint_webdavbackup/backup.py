@@ -0,0 +1,91 @@
+# coding=utf-8
+from __future__ import absolute_import
+import json
+import os
+import time
+from os import path as ospath
+from octoprint.settings import default_settings
+from octoprint.util.text import sanitize
+from octoprint.util.version import get_octoprint_version_string
+
+# Same as OctoPrint's backup plugin, so the archive can be restored from its settings page
+BACKUP_DATE_TIME_FMT = "%Y%m%d-%H%M%S"
+EXCLUDE_BY_DEFAULT = ("generated", "logs", "watched")
+
+
+def backup_name(settings):
+    prefix = settings.get(["appearance", "name"]) or "octoprint"
+    return sanitize(prefix) + "-backup-" + time.strftime(BACKUP_DATE_TIME_FMT) + ".zip"
+
+
+def _walk(source, target, ignored):
+    if source in ignored:
+        return
+    if ospath.isdir(source):
+        for entry in os.scandir(source):
+            for item in _walk(entry.path, ospath.join(target, entry.name), ignored):
+                yield item
+    elif ospath.isfile(source):
+        yield source, target
+
+
+def backup_hooks(plugin_manager, name, logger, **kwargs):
+    # Runs the octoprint.plugin.backup.<name> hooks, e.g. so plugins can pause something while the backup is made
+    if plugin_manager is None:
+        return
+    for plugin, hook in plugin_manager.get_hooks("octoprint.plugin.backup." + name).items():
+        try:
+            hook(**kwargs)
+        except Exception:
+            logger.exception("Error while running " + name + " hook from plugin " + plugin, extra=dict(plugin=plugin))
+
+
+def backup_excludes(settings, plugin_manager, exclude, logger):
+    # Folders and plugin data left out of the backup
+    exclude = list(exclude)
+    if "timelapse" in exclude:
+        exclude.append("timelapse_tmp")
+
+    # Plugins can keep parts of their data folder out of backups
+    current_excludes = list(exclude)
+    additional_excludes = []
+    plugin_data = settings.getBaseFolder("data")
+    if plugin_manager is not None:
+        for plugin, hook in plugin_manager.get_hooks("octoprint.plugin.backup.additional_excludes").items():
+            try:
+                additional = hook(current_excludes)
+                if isinstance(additional, list):
+                    if "." in additional:
+                        current_excludes.append(ospath.join("data", plugin))
+                        additional_excludes.append(ospath.join(plugin_data, plugin))
+                    else:
+                        current_excludes += [ospath.join("data", plugin, entry) for entry in additional]
+                        additional_excludes += [ospath.join(plugin_data, plugin, entry) for entry in additional]
+            except Exception:
+                logger.exception("Error while retrieving additional excludes from plugin " + plugin, extra=dict(plugin=plugin))
+    return exclude, additional_excludes
+
+
+def backup_contents(settings, plugin_manager, exclude, additional_excludes):
+    # (local path, name) of every file OctoPrint's backup plugin would add, plus the generated files, in the same layout
+    plugin_data = settings.getBaseFolder("data")
+    basedir = settings._basedir
+    # Backups made by OctoPrint itself
+    own_folder = ospath.join(plugin_data, "backup")
+    folders = [folder for folder in default_settings["folder"].keys() if folder not in exclude and folder not in EXCLUDE_BY_DEFAULT]
+
+    files = list(_walk(settings._configfile, "basedir/config.yaml", [own_folder]))
+    for folder in folders:
+        files += _walk(settings.getBaseFolder(folder), "basedir/" + folder.replace("_", "/"), [own_folder] + additional_excludes)
+    # Anything else that might be lying around in the basedir
+    defaults = [ospath.join(basedir, "config.yaml")] + [ospath.join(basedir, folder) for folder in default_settings["folder"].keys()]
+    files += _walk(basedir, "basedir", defaults + [own_folder] + additional_excludes)
+
+    contents = [("metadata.json", json.dumps(dict(version=get_octoprint_version_string(), excludes=exclude)))]
+    if plugin_manager is not None:
+        helpers = plugin_manager.get_helpers("pluginmanager", "generate_plugins_json")
+        if helpers and "generate_plugins_json" in helpers:
+            plugins = helpers["generate_plugins_json"](settings=settings, plugin_manager=plugin_manager)
+            if len(plugins):
+                contents.append(("plugin_list.json", json.dumps(plugins)))
+    return files, contents
@@ -0,0 +1,192 @@
+# coding=utf-8
+from __future__ import absolute_import
+import hashlib
+import logging
+from os import path as ospath
+from webdav3.client import WebDavXmlUtils
+from webdav3.exceptions import ResponseErrorCode
+from webdav3.urn import Urn
+from .client import upload_file
+
+# Nextcloud requires chunks of at least 5MB, except for the last one
+NEXTCLOUD_MIN_CHUNK_SIZE = 5 * 1024 * 1024
+
+
+class RangeNotSupported(Exception):
+    pass
+
+
+class FileSlice(object):
+    # File-like view on part of a file, so requests can stream it with a proper Content-Length
+    def __init__(self, file_object, offset, length):
+        self._file = file_object
+        self._file.seek(offset)
+        self._remaining = length
+
+    def __len__(self):
+        return self._remaining
+
+    def read(self, size=-1):
+        if self._remaining <= 0:
+            return b""
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._file.read(size)
+        self._remaining -= len(data)
+        return data
+
+
+def nextcloud_uploads_url(hostname, login):
+    # Nextcloud (and ownCloud) serve files below /remote.php/dav/files/<user>, the chunk uploads live next to them.
+    # Chunks can't be assembled into the legacy /remote.php/webdav endpoint.
+    if not hostname or not login or "/remote.php/dav/files/" not in hostname:
+        return None
+    return hostname.split("/remote.php/dav/files/")[0] + "/remote.php/dav/uploads/" + login
+
+
+class ChunkedUpload(object):
+    def __init__(self, client, chunk_size, capabilities, progress=None):
+        self._logger = logging.getLogger("octoprint.plugins.webdavbackup.chunked")
+        self._client = client
+        self._chunk_size = chunk_size
+        # Shared dict remembering which servers turned out not to support ranged uploads
+        self._capabilities = capabilities
+        self._progress = progress
+
+    def upload(self, job, local_file_path, remote_path):
+        # The chunk size has to stay the same between attempts for resuming to work
+        if not job.chunk_size:
+            job.chunk_size = self._chunk_size
+
+        uploads_url = nextcloud_uploads_url(self._client.webdav.hostname, self._client.webdav.login)
+        if uploads_url and self._capabilities.get(uploads_url) is not False:
+            job.chunk_size = max(job.chunk_size, NEXTCLOUD_MIN_CHUNK_SIZE)
+            try:
+                if self._upload_nextcloud(job, local_file_path, remote_path, uploads_url):
+                    return
+            except ResponseErrorCode as exception:
+                # Timeouts and rate limits are worth another attempt, anything else means chunking doesn't work here
+                if not 400 <= exception.code < 500 or exception.code in (408, 429):
+                    raise
+                self._logger.warning("Nextcloud chunked upload was refused with " + str(exception.code) + ", falling back to ranged uploads")
+            self._capabilities[uploads_url] = False
+            job.offset = 0
+
+        hostname = self._client.webdav.hostname
+        if self._capabilities.get(hostname) is not False:
+            try:
+                self._upload_ranges(job, local_file_path, remote_path)
+                return
+            except RangeNotSupported:
+                self._logger.warning("Server " + hostname + " does not support resumable uploads, sending the whole file instead")
+                self._capabilities[hostname] = False
+
+        job.offset = 0
+        upload_file(self._client, remote_path, local_file_path)
+
+    def _upload_nextcloud(self, job, local_file_path, remote_path, uploads_url):
+        total = ospath.getsize(local_file_path)
+        upload_dir = uploads_url + "/webdavbackup-" + hashlib.sha1((job.key or job.id).encode("utf-8")).hexdigest()[:16]
+        destination = self._client.get_url(Urn(remote_path).quote())
+        headers = {"Destination": destination, "OC-Total-Length": str(total)}
+
+        response = self._request("MKCOL", upload_dir, headers=headers, allowed=(405, 404, 409))
+        if response.status_code in (404, 409):
+            self._logger.info("Server does not support Nextcloud chunked uploads, falling back to ranged uploads")
+            return False
+
+        # Skip all chunks the server already has, only the missing tail is sent again
+        committed = {}
+        if response.status_code == 405:
+            committed = self._list_chunks(upload_dir)
+        offset = 0
+        index = 1
+        while offset < total and committed.get(index) == min(job.chunk_size, total - offset):
+            offset += committed[index]
+            index += 1
+        if offset:
+            self._logger.info("Resuming upload of " + local_file_path + " at " + str(offset) + " of " + str(total) + " bytes")
+        self._set_offset(job, offset)
+
+        with open(local_file_path, "rb") as local_file:
+            while offset < total:
+                length = min(job.chunk_size, total - offset)
+                self._request("PUT", upload_dir + "/%05d" % index, headers=headers, data=FileSlice(local_file, offset, length))
+                offset += length
+                index += 1
+                self._set_offset(job, offset)
+
+        self._logger.debug("Assembling " + str(index - 1) + " chunks into " + remote_path)
+        self._request("MOVE", upload_dir + "/.file", headers=dict(headers, Overwrite="T"))
+        return True
+
+    def _upload_ranges(self, job, local_file_path, remote_path):
+        total = ospath.getsize(local_file_path)
+        url = self._client.get_url(Urn(remote_path).quote())
+
+        # Only trust what the server actually committed
+        remote_size = self._remote_size(url)
+        offset = min(job.offset or 0, remote_size or 0)
+        if offset:
+            self._logger.info("Resuming upload of " + local_file_path + " at " + str(offset) + " of " + str(total) + " bytes")
+        self._set_offset(job, offset)
+
+        verified = False
+        with open(local_file_path, "rb") as local_file:
+            while offset < total:
+                length = min(job.chunk_size, total - offset)
+                if offset == 0:
+                    self._request("PUT", url, data=FileSlice(local_file, offset, length))
+                else:
+                    headers = {"Content-Range": "bytes %d-%d/%d" % (offset, offset + length - 1, total)}
+                    response = self._request("PUT", url, headers=headers, data=FileSlice(local_file, offset, length), allowed=(400, 416, 501))
+                    if response.status_code >= 400:
+                        raise RangeNotSupported()
+                    # Some servers silently replace the file instead of appending, check once per attempt
+                    if not verified:
+                        if self._remote_size(url) != offset + length:
+                            raise RangeNotSupported()
+                        verified = True
+                offset += length
+                self._set_offset(job, offset)
+
+        if self._remote_size(url) != total:
+            raise RangeNotSupported()
+
+    def _set_offset(self, job, offset):
+        job.offset = offset
+        if self._progress is not None:
+            self._progress(job)
+
+    def _list_chunks(self, upload_dir):
+        response = self._request("PROPFIND", upload_dir, headers={"Depth": "1"})
+        chunks = {}
+        for info in WebDavXmlUtils.parse_get_list_info_response(response.content):
+            name = ospath.basename(info["path"].rstrip("/"))
+            if not info["isdir"] and name.isdigit() and info["size"]:
+                chunks[int(name)] = int(info["size"])
+        return chunks
+
+    def _remote_size(self, url):
+        response = self._request("PROPFIND", url, headers={"Depth": "0"}, allowed=(404,))
+        if response.status_code == 404:
+            return None
+        for info in WebDavXmlUtils.parse_get_list_info_response(response.content):
+            if info["size"]:
+                return int(info["size"])
+        return 0
+
+    def _request(self, method, url, headers=None, data=None, allowed=()):
+        webdav = self._client.webdav
+        response = self._client.session.request(
+            method=method,
+            url=url,
+            auth=(webdav.login, webdav.password) if webdav.login and webdav.password else None,
+            headers=headers,
+            data=data,
+            timeout=self._client.timeout,
+            verify=self._client.verify,
+        )
+        if response.status_code >= 400 and response.status_code not in allowed:
+            raise ResponseErrorCode(url=url, code=response.status_code, message=response.content)
+        return response
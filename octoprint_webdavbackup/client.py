@@ -0,0 +1,153 @@
+# coding=utf-8
+from __future__ import absolute_import
+import logging
+import threading
+import time
+from lxml import etree
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.utils import super_len
+from webdav3.client import Client
+from webdav3.exceptions import RemoteResourceNotFound
+from webdav3.urn import Urn
+from .throttle import ThrottledStream
+
+
+class PooledSession(Session):
+    def __init__(self, throttle=None):
+        Session.__init__(self)
+        # Token bucket shared by all uploads
+        self.throttle = throttle
+
+    def request(self, method, url, data=None, **kwargs):
+        # webdav3 streams every response but hardly ever reads them, which keeps connections from being reused
+        kwargs["stream"] = False
+        if self.throttle is not None and method == "PUT" and data is not None and (hasattr(data, "read") or hasattr(data, "__next__")):
+            length = data.len if hasattr(data, "len") else super_len(data)
+            data = ThrottledStream(data, self.throttle, length)
+        return Session.request(self, method, url, data=data, **kwargs)
+
+
+def _client_key(davoptions, verify):
+    return (
+        davoptions.get("webdav_hostname"),
+        davoptions.get("webdav_login"),
+        davoptions.get("webdav_password"),
+        davoptions.get("webdav_timeout"),
+        davoptions.get("disable_check"),
+        verify,
+    )
+
+
+class ClientPool(object):
+    # Keeps one long-lived client per server and set of credentials, so uploads reuse warm connections
+    def __init__(self, pool_size=4, idle_timeout=60, throttle=None):
+        self._logger = logging.getLogger("octoprint.plugins.webdavbackup.client")
+        self._lock = threading.Lock()
+        self._clients = dict()
+        self._pool_size = pool_size
+        self._idle_timeout = idle_timeout
+        self._throttle = throttle
+
+    def configure(self, pool_size, idle_timeout):
+        with self._lock:
+            changed = pool_size != self._pool_size
+            self._pool_size = pool_size
+            self._idle_timeout = idle_timeout
+        if changed:
+            self.reset()
+
+    def get(self, davoptions, verify=True):
+        key = _client_key(davoptions, verify)
+        now = time.time()
+        with self._lock:
+            entry = self._clients.get(key)
+            if entry is None:
+                self._logger.debug("Creating WebDAV client for " + str(davoptions.get("webdav_hostname")))
+                entry = self._clients[key] = dict(client=self._create(davoptions, verify), last_used=now)
+            elif self._idle_timeout and now - entry["last_used"] > self._idle_timeout:
+                # The server has most likely closed idle connections by now, don't try to reuse them
+                self._logger.debug("Connections to " + str(davoptions.get("webdav_hostname")) + " have been idle, reconnecting")
+                entry["client"].session.close()
+            entry["last_used"] = now
+            return entry["client"]
+
+    def retain(self, davoptions_list):
+        # Drop clients for servers or credentials that are no longer configured
+        keep = set(_client_key(davoptions, verify) for davoptions, verify in davoptions_list)
+        with self._lock:
+            stale = [key for key in self._clients if key not in keep]
+            for key in stale:
+                self._clients.pop(key)["client"].session.close()
+        if stale:
+            self._logger.debug("Closed " + str(len(stale)) + " WebDAV clients after settings change")
+
+    def reset(self):
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for entry in clients:
+            entry["client"].session.close()
+
+    def _create(self, davoptions, verify):
+        client = Client(davoptions)
+        client.verify = verify
+        client.session = PooledSession(throttle=self._throttle)
+        # Block instead of opening extra connections when all of them are in use
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self._pool_size, pool_block=True)
+        client.session.mount("http://", adapter)
+        client.session.mount("https://", adapter)
+        return client
+
+
+# Same as Client.upload_file and Client.move, without checking the remote directories first
+def upload_file(client, remote_path, local_path):
+    with open(local_path, "rb") as local_file:
+        return upload_stream(client, remote_path, local_file)
+
+
+def upload_stream(client, remote_path, stream):
+    return client.execute_request(action="upload", path=Urn(remote_path).quote(), data=stream)
+
+
+def move(client, remote_path_from, remote_path_to, overwrite=False):
+    headers = [
+        "Destination: " + client.get_url(Urn(remote_path_to).quote()),
+        "Overwrite: " + ("T" if overwrite else "F"),
+    ]
+    return client.execute_request(action="move", path=Urn(remote_path_from).quote(), headers_ext=headers)
+
+
+def copy(client, remote_path_from, remote_path_to, overwrite=False):
+    headers = [
+        "Destination: " + client.get_url(Urn(remote_path_to).quote()),
+        "Overwrite: " + ("T" if overwrite else "F"),
+    ]
+    return client.execute_request(action="copy", path=Urn(remote_path_from).quote(), headers_ext=headers)
+
+
+def delete(client, remote_path):
+    return client.execute_request(action="clean", path=Urn(remote_path).quote())
+
+
+PROPERTIES_REQUEST = (
+    '<?xml version="1.0" encoding="utf-8"?>'
+    '<d:propfind xmlns:d="DAV:" xmlns:oc="http://owncloud.org/ns">'
+    '<d:prop><d:getetag/><d:getcontentlength/><oc:checksums/></d:prop>'
+    '</d:propfind>'
+)
+
+
+def properties(client, remote_path):
+    # ETag, size and (on Nextcloud/ownCloud) checksums of a remote file, or None if it doesn't exist
+    try:
+        response = client.execute_request(action="info", path=Urn(remote_path).quote(), data=PROPERTIES_REQUEST, headers_ext=["Depth: 0"])
+    except RemoteResourceNotFound:
+        return None
+    tree = etree.fromstring(response.content)
+    size = tree.findtext(".//{DAV:}getcontentlength")
+    return dict(
+        etag=tree.findtext(".//{DAV:}getetag"),
+        size=int(size) if size else None,
+        checksums=[entry for checksum in tree.iter("{http://owncloud.org/ns}checksum") for entry in (checksum.text or "").lower().split()],
+    )
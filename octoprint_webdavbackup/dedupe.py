@@ -0,0 +1,62 @@
+# coding=utf-8
+from __future__ import absolute_import
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+
+
+def file_sha256(local_file_path, chunk_size=1024 * 1024):
+    sha256 = hashlib.sha256()
+    with open(local_file_path, "rb") as local_file:
+        for data in iter(lambda: local_file.read(chunk_size), b""):
+            sha256.update(data)
+    return sha256.hexdigest()
+
+
+class ContentIndex(object):
+    # Remembers what content was uploaded where, so unchanged files don't have to be uploaded again
+    def __init__(self, db_path):
+        self._logger = logging.getLogger("octoprint.plugins.webdavbackup.dedupe")
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS uploaded ("
+            " hostname TEXT NOT NULL,"
+            " remote_file TEXT NOT NULL,"
+            " sha256 TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " etag TEXT,"
+            " remote_size INTEGER,"
+            " updated REAL NOT NULL,"
+            " PRIMARY KEY (hostname, remote_file)"
+            ")"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS uploaded_content ON uploaded (sha256, size)")
+
+    def find(self, hostname, sha256, size):
+        # Remote files known to have this content, most recent first
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT remote_file, etag, remote_size FROM uploaded WHERE hostname = ? AND sha256 = ? AND size = ? ORDER BY updated DESC",
+                (hostname, sha256, size),
+            ).fetchall()
+        return rows
+
+    def add(self, hostname, remote_file, sha256, size, etag=None, remote_size=None):
+        # The remote size differs from the local size when the file was compressed
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO uploaded (hostname, remote_file, sha256, size, etag, remote_size, updated) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (hostname, remote_file, sha256, size, etag, remote_size if remote_size is not None else size, time.time()),
+            )
+
+    def remove(self, hostname, remote_file):
+        with self._lock:
+            self._db.execute("DELETE FROM uploaded WHERE hostname = ? AND remote_file = ?", (hostname, remote_file))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
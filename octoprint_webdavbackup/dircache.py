@@ -0,0 +1,88 @@
+# coding=utf-8
+from __future__ import absolute_import
+import logging
+import posixpath
+import threading
+import time
+from webdav3.exceptions import MethodNotSupported, ResponseErrorCode
+from webdav3.urn import Urn
+
+
+def _normalize(path):
+    return posixpath.normpath(posixpath.join("/", path))
+
+
+class RemoteDirectoryCache(object):
+    # Remembers which remote directories exist, so most uploads need no directory checks at all
+    def __init__(self, ttl=3600):
+        self._logger = logging.getLogger("octoprint.plugins.webdavbackup.dircache")
+        self._lock = threading.Lock()
+        self._known = dict()
+        self._ttl = ttl
+
+    def set_ttl(self, ttl):
+        self._ttl = ttl
+
+    def known(self, hostname, path):
+        key = (hostname, _normalize(path))
+        with self._lock:
+            added = self._known.get(key)
+            if added is None:
+                return False
+            if self._ttl and time.time() - added > self._ttl:
+                del self._known[key]
+                return False
+            return True
+
+    def add(self, hostname, path):
+        with self._lock:
+            self._known[(hostname, _normalize(path))] = time.time()
+
+    def invalidate(self, hostname, path="/"):
+        # Forget the directory and everything below it
+        path = _normalize(path)
+        prefix = path.rstrip("/") + "/"
+        with self._lock:
+            for key in list(self._known):
+                if key[0] == hostname and (key[1] == path or key[1].startswith(prefix)):
+                    del self._known[key]
+
+    def clear(self):
+        with self._lock:
+            self._known.clear()
+
+    def ensure(self, client, path, retry=True):
+        hostname = client.webdav.hostname
+        path = _normalize(path)
+        if self.known(hostname, path):
+            return True
+
+        # Find the deepest directory we know about, and create everything below it top-down
+        missing = []
+        parent = path
+        while parent != "/" and not self.known(hostname, parent):
+            missing.insert(0, parent)
+            parent = posixpath.dirname(parent)
+
+        for directory in missing:
+            try:
+                client.execute_request(action="mkdir", path=Urn(directory, directory=True).quote())
+                self._logger.debug("Directory " + directory + " has been created.")
+            except MethodNotSupported:
+                # MKCOL on an existing directory is not allowed, so it is already there
+                self._logger.debug("Directory " + directory + " was found.")
+            except ResponseErrorCode as exception:
+                if exception.code != 409:
+                    raise
+                if retry and parent != "/":
+                    # A directory we thought existed is gone, forget about all of them and start over
+                    self._logger.debug("Parent of directory " + directory + " has disappeared, checking the whole path again.")
+                    while parent != "/":
+                        with self._lock:
+                            self._known.pop((hostname, parent), None)
+                        parent = posixpath.dirname(parent)
+                    return self.ensure(client, path, retry=False)
+                self._logger.error("Parent of directory " + directory + " was not found, something is probably wrong with your settings.")
+                return False
+            self.add(hostname, directory)
+        return True
@@ -0,0 +1,50 @@
+# coding=utf-8
+from __future__ import absolute_import
+import re
+import time
+from fnmatch import translate
+from os import path as ospath
+
+
+def _compile(patterns):
+    if not patterns:
+        return None
+    # Patterns are relative to the root of the folder, but * also matches subfolders
+    return re.compile("|".join(translate(ospath.join("/", pattern)) for pattern in patterns), re.IGNORECASE)
+
+
+class FileFilter(object):
+    # Comma separated glob patterns compiled into a single regex, patterns starting with ! exclude files
+    def __init__(self, patterns, min_size=0, max_size=0, max_age=0):
+        include = []
+        exclude = []
+        for pattern in (patterns or "").split(","):
+            pattern = pattern.strip()
+            if pattern.startswith("!"):
+                exclude.append(pattern[1:].strip())
+            elif pattern:
+                include.append(pattern)
+        # With only exclude patterns, everything else is included
+        self._include = _compile(include)
+        self._exclude = _compile([pattern for pattern in exclude if pattern])
+        # Sizes in bytes, age in seconds, 0 disables the check
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_age = max_age
+
+    @property
+    def needs_stat(self):
+        return bool(self.min_size or self.max_size or self.max_age)
+
+    def matches(self, file_path):
+        file_path = ospath.join("/", file_path)
+        if self._include is not None and not self._include.match(file_path):
+            return False
+        return self._exclude is None or not self._exclude.match(file_path)
+
+    def check(self, file_stat):
+        if self.min_size and file_stat.st_size < self.min_size:
+            return False
+        if self.max_size and file_stat.st_size > self.max_size:
+            return False
+        return not self.max_age or time.time() - file_stat.st_mtime <= self.max_age
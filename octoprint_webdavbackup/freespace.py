@@ -0,0 +1,48 @@
+# coding=utf-8
+from __future__ import absolute_import
+import logging
+import threading
+import time
+
+
+class FreeSpaceTracker(object):
+    # Remembers the free space per server, and keeps it up to date locally with every upload
+    def __init__(self, refresh_interval=600):
+        self._logger = logging.getLogger("octoprint.plugins.webdavbackup.freespace")
+        self._lock = threading.Lock()
+        self._free = dict()
+        self._refresh_interval = refresh_interval
+
+    def set_refresh_interval(self, refresh_interval):
+        self._refresh_interval = refresh_interval
+
+    def get(self, client, required_size=0):
+        hostname = client.webdav.hostname
+        now = time.time()
+        with self._lock:
+            entry = self._free.get(hostname)
+        if entry is not None:
+            free, fetched = entry
+            expired = not self._refresh_interval or now - fetched > self._refresh_interval
+            # Close to the file size the estimate isn't good enough, ask the server again
+            if not expired and (free < 0 or free - required_size >= required_size):
+                self._logger.debug("Using cached free space of " + str(free) + " bytes")
+                return free
+
+        free = client.free()
+        with self._lock:
+            self._free[hostname] = (free, now)
+        return free
+
+    def consume(self, hostname, size):
+        with self._lock:
+            entry = self._free.get(hostname)
+            if entry is not None and entry[0] >= 0:
+                self._free[hostname] = (max(0, entry[0] - size), entry[1])
+
+    def invalidate(self, hostname=None):
+        with self._lock:
+            if hostname is None:
+                self._free.clear()
+            else:
+                self._free.pop(hostname, None)
@@ -0,0 +1,91 @@
+# coding=utf-8
+from __future__ import absolute_import
+import json
+import logging
+import sqlite3
+import threading
+import time
+from os import stat as osstat
+
+# Journal states
+PENDING = "pending"
+UPLOADING = "uploading"
+DONE = "done"
+FAILED = "failed"
+
+
+def job_key(local_file_path):
+    # A file is identified by its path, modification time and size, so an unchanged file is only uploaded once
+    try:
+        file_stat = osstat(local_file_path)
+    except OSError:
+        return None
+    return "%s:%d:%d" % (local_file_path, file_stat.st_mtime_ns, file_stat.st_size)
+
+
+class UploadJournal(object):
+    def __init__(self, db_path):
+        self._logger = logging.getLogger("octoprint.plugins.webdavbackup.journal")
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " key TEXT PRIMARY KEY,"
+            " id TEXT NOT NULL,"
+            " status TEXT NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " next_attempt REAL NOT NULL DEFAULT 0,"
+            " error TEXT,"
+            " data TEXT NOT NULL,"
+            " updated REAL NOT NULL"
+            ")"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+
+    def add(self, job, again=False):
+        # Returns False if the same file is already pending or has been uploaded before, unless it should be uploaded again
+        if job.key is None:
+            return True
+        with self._lock:
+            row = self._db.execute("SELECT status FROM jobs WHERE key = ?", (job.key,)).fetchone()
+            if row is not None and row[0] != FAILED and not (again and row[0] == DONE):
+                self._logger.info("Upload of " + job.local_file_path + " is already " + row[0] + ", skipping duplicate")
+                return False
+            self._db.execute(
+                "INSERT OR REPLACE INTO jobs (key, id, status, attempts, next_attempt, error, data, updated) VALUES (?, ?, ?, 0, 0, NULL, ?, ?)",
+                (job.key, job.id, PENDING, json.dumps(job.as_dict()), time.time()),
+            )
+        return True
+
+    def update(self, job, status, next_attempt=0):
+        if job.key is None:
+            return
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET status = ?, attempts = ?, next_attempt = ?, error = ?, data = ?, updated = ? WHERE key = ?",
+                (status, job.attempts, next_attempt, job.error, json.dumps(job.as_dict()), time.time(), job.key),
+            )
+
+    def pending(self):
+        # Jobs that were uploading when OctoPrint stopped are picked up again as well
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT data, next_attempt FROM jobs WHERE status IN (?, ?) ORDER BY next_attempt",
+                (PENDING, UPLOADING),
+            ).fetchall()
+        return [(json.loads(data), next_attempt) for data, next_attempt in rows]
+
+    def prune(self, max_age):
+        with self._lock:
+            cursor = self._db.execute(
+                "DELETE FROM jobs WHERE status IN (?, ?) AND updated < ?",
+                (DONE, FAILED, time.time() - max_age),
+            )
+        if cursor.rowcount:
+            self._logger.debug("Removed " + str(cursor.rowcount) + " old entries from the upload journal")
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,139 @@
+# coding=utf-8
+from __future__ import absolute_import
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Upper bounds in seconds, from a cached directory check up to a large timelapse
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+
+
+class Histogram(object):
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _labels(**labels):
+    return "{" + ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"')) for name, value in sorted(labels.items())) + "}"
+
+
+class UploadMetrics(object):
+    # Collects timings and counters of all uploads, every worker thread keeps track of the upload it is working on
+    def __init__(self, history=20):
+        self._lock = threading.Lock()
+        self._current = threading.local()
+        self._phases = dict()
+        self._uploads = Histogram()
+        self._results = dict()
+        self._failures = dict()
+        self._bytes = 0
+        self._recent = deque(maxlen=history)
+
+    def begin(self, name, size):
+        self._current.upload = dict(name=name, size=size, bytes=0, phase=None, started=time.time(), phases=dict())
+
+    def end(self, success, error=None):
+        upload = getattr(self._current, "upload", None)
+        if upload is None:
+            return
+        self._current.upload = None
+        duration = time.time() - upload["started"]
+        result = "success" if success else "failure"
+        with self._lock:
+            self._uploads.observe(duration)
+            self._results[result] = self._results.get(result, 0) + 1
+            if not success:
+                # The last step that was started before it went wrong
+                phase = upload["phase"] or "unknown"
+                self._failures[phase] = self._failures.get(phase, 0) + 1
+            self._recent.appendleft(dict(
+                name=upload["name"],
+                size=upload["size"],
+                bytes=upload["bytes"],
+                result=result,
+                error=error,
+                finished=time.time(),
+                duration=round(duration, 3),
+                phases=upload["phases"],
+                speed=round(upload["bytes"] / duration / 1024 / 1024, 2) if duration > 0 else 0,
+            ))
+
+    @contextmanager
+    def phase(self, name):
+        upload = getattr(self._current, "upload", None)
+        if upload is not None:
+            upload["phase"] = name
+        started = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - started
+            with self._lock:
+                self._phases.setdefault(name, Histogram()).observe(duration)
+            if upload is not None:
+                upload["phases"][name] = round(upload["phases"].get(name, 0) + duration, 3)
+
+    def add_bytes(self, size):
+        with self._lock:
+            self._bytes += size
+        upload = getattr(self._current, "upload", None)
+        if upload is not None:
+            upload["bytes"] += size
+
+    def as_dict(self, queue_status=None):
+        with self._lock:
+            return dict(
+                uploads=dict(self._results),
+                failures=dict(self._failures),
+                bytes=self._bytes,
+                phases=dict((name, dict(count=histogram.count, sum=round(histogram.sum, 3))) for name, histogram in self._phases.items()),
+                recent=list(self._recent),
+                queue=queue_status,
+            )
+
+    def prometheus(self, queue_status=None):
+        lines = []
+
+        def histogram(metric, help_text, histograms):
+            lines.append("# HELP " + metric + " " + help_text)
+            lines.append("# TYPE " + metric + " histogram")
+            for labels, values in histograms:
+                for bound, count in zip(values.buckets, values.counts):
+                    lines.append(metric + "_bucket" + _labels(le=bound, **labels) + " " + str(count))
+                lines.append(metric + "_bucket" + _labels(le="+Inf", **labels) + " " + str(values.count))
+                lines.append(metric + "_sum" + (_labels(**labels) if labels else "") + " " + repr(values.sum))
+                lines.append(metric + "_count" + (_labels(**labels) if labels else "") + " " + str(values.count))
+
+        def simple(metric, metric_type, help_text, values):
+            lines.append("# HELP " + metric + " " + help_text)
+            lines.append("# TYPE " + metric + " " + metric_type)
+            for labels, value in values:
+                lines.append(metric + (_labels(**labels) if labels else "") + " " + str(value))
+
+        with self._lock:
+            histogram("webdavbackup_phase_duration_seconds", "Time spent in each step of an upload.",
+                      [(dict(phase=name), values) for name, values in sorted(self._phases.items())])
+            histogram("webdavbackup_upload_duration_seconds", "Total time spent per upload.", [(dict(), self._uploads)])
+            simple("webdavbackup_uploads_total", "counter", "Finished uploads by result.",
+                   [(dict(result=result), count) for result, count in sorted(self._results.items())])
+            simple("webdavbackup_upload_failures_total", "counter", "Failed uploads by the step they failed in.",
+                   [(dict(phase=phase), count) for phase, count in sorted(self._failures.items())])
+            simple("webdavbackup_upload_bytes_total", "counter", "Bytes sent to the WebDAV server.", [(None, self._bytes)])
+
+        if queue_status is not None:
+            simple("webdavbackup_queue_depth", "gauge", "Uploads waiting in the queue.", [(None, queue_status["depth"])])
+            simple("webdavbackup_queue_capacity", "gauge", "Maximum number of uploads waiting in the queue.", [(None, queue_status["capacity"])])
+            simple("webdavbackup_queue_overflow", "gauge", "Uploads waiting for room in the queue.", [(None, queue_status["overflow"])])
+            simple("webdavbackup_queue_deferred", "gauge", "Uploads held back until the current print is done.", [(None, queue_status["deferred"])])
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,215 @@
+# coding=utf-8
+from __future__ import absolute_import
+import logging
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from os import path as ospath
+from urllib.parse import unquote, urlsplit
+from lxml import etree
+from webdav3.exceptions import ResponseErrorCode, RemoteResourceNotFound
+from webdav3.urn import Urn
+from .client import delete as dav_delete
+
+LISTING_REQUEST = (
+    '<?xml version="1.0" encoding="utf-8"?>'
+    '<d:propfind xmlns:d="DAV:">'
+    '<d:prop><d:resourcetype/><d:getcontentlength/><d:getlastmodified/></d:prop>'
+    '</d:propfind>'
+)
+
+
+def static_prefix(path_template):
+    # The part of a path template that doesn't depend on the date, e.g. /backups for /backups/%Y/%m
+    path_template = ospath.join("/", path_template or "")
+    if "%" in path_template:
+        # Cut off at the last directory before the first date variable
+        path_template = path_template[:path_template.index("%")].rsplit("/", 1)[0]
+    return path_template.rstrip("/") or "/"
+
+
+# Date variables that produce a path of their own, e.g. 10/17/26
+_PATH_DIRECTIVES = {"D": "*/*/*", "x": "*/*/*"}
+
+
+def template_pattern(template):
+    # Turns a strftime template into a glob pattern matching everything it could produce
+    return re.sub(r"%-?(.)", lambda match: _PATH_DIRECTIVES.get(match.group(1), "*"), (template or "").replace("%%", "\0")).replace("\0", "%")
+
+
+def is_specific(name_pattern):
+    # A name with some letters or digits of its own, not just date variables and wildcards
+    return re.search(r"[A-Za-z0-9]", name_pattern or "") is not None
+
+
+def compile_patterns(patterns):
+    # Unlike fnmatch, * and ? never match a /, so only files at the depth the path template produces match
+    def translate(pattern):
+        return "".join("[^/]*" if char == "*" else "[^/]" if char == "?" else re.escape(char) for char in pattern)
+    return re.compile("(?:" + "|".join(translate(pattern) for pattern in patterns) + r")\Z")
+
+
+def pattern_depth(patterns, prefix):
+    # How many levels below prefix the patterns reach, e.g. 3 for /backups/*/*/*.zip below /backups
+    prefix = prefix.rstrip("/")
+    return max([pattern[len(prefix):].strip("/").count("/") + 1 for pattern in patterns] or [0])
+
+
+def list_files(client, path, max_depth=None):
+    # Everything below path, up to max_depth levels deep, in as few requests as possible. Servers may refuse an infinite
+    # depth, or like Nextcloud silently answer with a depth of 1, so directories whose contents are missing are walked
+    # one level at a time
+    files = []
+    directories = deque()
+    try:
+        _collect(_propfind(client, path, "1" if max_depth == 1 else "infinity"), path, path, files, directories, max_depth)
+    except RemoteResourceNotFound:
+        # Nothing has been uploaded here yet
+        return []
+    except ResponseErrorCode as exception:
+        if exception.code not in (400, 403, 501):
+            raise
+        directories.append(path)
+    while directories:
+        directory = directories.popleft()
+        _collect(_propfind(client, directory, "1"), directory, path, files, directories, max_depth)
+    return files
+
+
+def _collect(entries, directory, path, files, directories, max_depth=None):
+    # Collects the files of a listing of directory, directories without any of their contents in it still have to be
+    # listed unless they are more than max_depth levels below path
+    root = path.rstrip("/")
+    listed = directory.rstrip("/")
+    parents = set(ospath.dirname(entry["path"].rstrip("/")) for entry in entries)
+    for entry in entries:
+        entry_path = entry["path"].rstrip("/")
+        if entry_path == listed or not entry_path.startswith(root + "/"):
+            continue
+        depth = entry_path[len(root):].count("/")
+        if max_depth is not None and depth > max_depth:
+            continue
+        if not entry["isdir"]:
+            files.append(entry)
+        elif entry_path not in parents and (max_depth is None or depth < max_depth):
+            directories.append(entry["path"])
+
+
+def _propfind(client, path, depth):
+    response = client.execute_request(action="info", path=Urn(path, directory=True).quote(), data=LISTING_REQUEST, headers_ext=["Depth: " + depth])
+    # hrefs include the path of the server URL, which is not part of the remote paths used everywhere else
+    root = unquote(urlsplit(client.get_url("")).path).rstrip("/")
+    entries = []
+    for element in etree.fromstring(response.content).iter("{DAV:}response"):
+        href = unquote(urlsplit(element.findtext("{DAV:}href")).path)
+        if href.startswith(root):
+            href = href[len(root):]
+        isdir = element.find(".//{DAV:}collection") is not None
+        size = element.findtext(".//{DAV:}getcontentlength")
+        modified = element.findtext(".//{DAV:}getlastmodified")
+        entries.append(dict(
+            path=ospath.join("/", href),
+            isdir=isdir,
+            size=int(size) if size else 0,
+            modified=parsedate_to_datetime(modified) if modified else None,
+        ))
+    return entries
+
+
+def select_expired(files, keep_last=0, keep_daily=0, keep_weekly=0, keep_monthly=0, max_size=0):
+    # Files to delete according to the policy, the most recent file is always kept
+    files = sorted(files, key=lambda entry: entry["modified"], reverse=True)
+    if not files:
+        return []
+
+    if keep_last or keep_daily or keep_weekly or keep_monthly:
+        keep = set(range(min(keep_last, len(files))))
+        for count, period in (
+            (keep_daily, lambda modified: modified.date()),
+            (keep_weekly, lambda modified: modified.isocalendar()[:2]),
+            (keep_monthly, lambda modified: (modified.year, modified.month)),
+        ):
+            # The newest file of each of the most recent periods
+            periods = set()
+            for index, entry in enumerate(files):
+                if len(periods) >= count:
+                    break
+                key = period(entry["modified"])
+                if key not in periods:
+                    periods.add(key)
+                    keep.add(index)
+        keep.add(0)
+    else:
+        keep = set(range(len(files)))
+
+    if max_size:
+        total = 0
+        for index in sorted(keep):
+            total += files[index]["size"]
+            if total > max_size and index:
+                keep.discard(index)
+
+    return [entry for index, entry in enumerate(files) if index not in keep]
+
+
+class RetentionPolicy(object):
+    def __init__(self, patterns, keep_last=0, keep_daily=0, keep_weekly=0, keep_monthly=0, max_size=0):
+        # Only remote files matching one of these glob patterns are subject to this policy
+        self.patterns = patterns
+        self._regex = compile_patterns(patterns) if patterns else None
+        self.keep_last = keep_last
+        self.keep_daily = keep_daily
+        self.keep_weekly = keep_weekly
+        self.keep_monthly = keep_monthly
+        self.max_size = max_size
+
+    def active(self):
+        return self._regex is not None and bool(self.keep_last or self.keep_daily or self.keep_weekly or self.keep_monthly or self.max_size)
+
+    def depth(self, prefix):
+        return pattern_depth(self.patterns, prefix)
+
+    def matches(self, remote_path):
+        return self._regex is not None and self._regex.match(remote_path) is not None
+
+    def expired(self, files):
+        if not self.active():
+            return []
+        matching = [entry for entry in files if entry["modified"] is not None and self.matches(entry["path"])]
+        return select_expired(matching, self.keep_last, self.keep_daily, self.keep_weekly, self.keep_monthly, self.max_size)
+
+
+def prune(client, prefix, policies, batch_size=20, parallel=4):
+    # One listing for all policies sharing the prefix, then the expired files are deleted a batch at a time
+    logger = logging.getLogger("octoprint.plugins.webdavbackup.retention")
+    # Nothing deeper than the path templates go can match, so it isn't listed either
+    files = list_files(client, prefix, max(policy.depth(prefix) for policy in policies))
+    expired = []
+    for policy in policies:
+        expired.extend(entry["path"] for entry in policy.expired(files))
+    if not expired:
+        logger.debug("Nothing to remove below " + prefix + ", found " + str(len(files)) + " files")
+        return []
+
+    logger.info("Removing " + str(len(expired)) + " of " + str(len(files)) + " files below " + prefix)
+    deleted = []
+    with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+        for start in range(0, len(expired), batch_size):
+            batch = expired[start:start + batch_size]
+            for remote_path, removed in zip(batch, executor.map(lambda remote_path: _delete(client, remote_path, logger), batch)):
+                if removed:
+                    deleted.append(remote_path)
+    return deleted
+
+
+def _delete(client, remote_path, logger):
+    try:
+        dav_delete(client, remote_path)
+        logger.debug("Removed " + remote_path)
+        return True
+    except RemoteResourceNotFound:
+        return True
+    except ResponseErrorCode as exception:
+        logger.warning("Unable to remove " + remote_path + ": HTTP error " + str(exception.code))
+        return False
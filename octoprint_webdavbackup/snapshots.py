@@ -0,0 +1,50 @@
+# coding=utf-8
+from __future__ import absolute_import
+import logging
+import threading
+from collections import OrderedDict
+
+
+class SnapshotBatcher(object):
+    # Collects timelapse snapshots and hands them over in batches, instead of uploading every single one
+    def __init__(self, flush_callback, batch_size=20, window=30):
+        self._logger = logging.getLogger("octoprint.plugins.webdavbackup.snapshots")
+        self._flush_callback = flush_callback
+        self._batch_size = batch_size
+        self._window = window
+        self._lock = threading.Lock()
+        # Snapshots per upload path, as the path may contain date variables
+        self._pending = OrderedDict()
+        self._timer = None
+
+    def configure(self, batch_size, window):
+        self._batch_size = max(1, batch_size)
+        self._window = window
+
+    def add(self, job):
+        with self._lock:
+            files = self._pending.setdefault(job.upload_path, [])
+            files.append((job.local_file_path, job.upload_name))
+            full = len(files) >= self._batch_size
+            if not full and self._timer is None and self._window:
+                self._timer = threading.Timer(self._window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if full or not self._window:
+            self.flush(job.upload_path)
+
+    def flush(self, upload_path=None):
+        with self._lock:
+            if upload_path is None:
+                batches = list(self._pending.items())
+                self._pending.clear()
+            else:
+                batches = [(upload_path, self._pending.pop(upload_path, []))]
+            if not self._pending and self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+        for path, files in batches:
+            if files:
+                self._logger.debug("Flushing batch of " + str(len(files)) + " snapshots for " + path)
+                self._flush_callback(path, files)
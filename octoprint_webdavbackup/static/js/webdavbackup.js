@@ -0,0 +1,101 @@
+/*
+ * View model for the WebDAV Backup upload statistics
+ */
+$(function() {
+    function WebDavBackupStatisticsViewModel(parameters) {
+        var self = this;
+
+        self.loginState = parameters[0];
+        self.access = parameters[1];
+
+        self.queueDepth = ko.observable(0);
+        self.queueCapacity = ko.observable(0);
+        self.queueDeferred = ko.observable(0);
+        self.uploadsSucceeded = ko.observable(0);
+        self.uploadsFailed = ko.observable(0);
+        self.bytesSent = ko.observable(0);
+        self.recentUploads = ko.observableArray([]);
+        self.syncRunning = ko.observable(false);
+        self.syncFinished = ko.observable(false);
+        self.syncChecked = ko.observable(0);
+        self.syncQueued = ko.observable(0);
+        self.backupRunning = ko.observable(false);
+        self.backupDeferred = ko.observable(false);
+        self.backupFinished = ko.observable(false);
+        self.backupName = ko.observable();
+        self.backupSize = ko.observable(0);
+        self.backupError = ko.observable();
+
+        self.formatSize = function(size) {
+            return formatSize(size);
+        };
+
+        self.formatPhases = function(phases) {
+            return _.map(phases, function(duration, phase) {
+                return phase + ": " + duration + " s";
+            }).join(", ");
+        };
+
+        self.refresh = function() {
+            if (!self.loginState.hasPermission(self.access.permissions.SETTINGS)) {
+                return;
+            }
+            OctoPrint.simpleApiGet("webdavbackup").done(function(response) {
+                if (response.queue) {
+                    self.queueDepth(response.queue.depth);
+                    self.queueCapacity(response.queue.capacity);
+                    self.queueDeferred(response.queue.deferred);
+                }
+                self.uploadsSucceeded(response.uploads.success || 0);
+                self.uploadsFailed(response.uploads.failure || 0);
+                self.bytesSent(response.bytes);
+                self.recentUploads(response.recent);
+                self.updateSync(response.sync);
+                self.updateBackup(response.backup);
+            });
+        };
+
+        self.updateSync = function(sync) {
+            self.syncRunning(sync.running);
+            self.syncFinished(!!sync.finished);
+            self.syncChecked(sync.checked);
+            self.syncQueued(sync.queued);
+            if (sync.running) {
+                // Keep checking until the sync is done
+                setTimeout(self.refresh, 2000);
+            }
+        };
+
+        self.sync = function() {
+            OctoPrint.simpleApiCommand("webdavbackup", "sync").done(function(response) {
+                self.updateSync(response.sync);
+            });
+        };
+
+        self.updateBackup = function(backup) {
+            self.backupRunning(backup.running);
+            self.backupDeferred(backup.deferred);
+            self.backupFinished(!!backup.finished);
+            self.backupName(backup.name);
+            self.backupSize(backup.size);
+            self.backupError(backup.error);
+            if (backup.running) {
+                setTimeout(self.refresh, 2000);
+            }
+        };
+
+        self.backup = function() {
+            OctoPrint.simpleApiCommand("webdavbackup", "backup").done(function(response) {
+                self.updateBackup(response.backup);
+            });
+        };
+
+        self.onSettingsShown = self.refresh;
+    }
+
+    OCTOPRINT_VIEWMODELS.push({
+        construct: WebDavBackupStatisticsViewModel,
+        dependencies: ["loginStateViewModel", "accessViewModel"],
+        elements: ["#settings_plugin_webdavbackup_statistics"]
+    });
+});
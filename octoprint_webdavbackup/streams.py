@@ -0,0 +1,187 @@
+# coding=utf-8
+from __future__ import absolute_import
+import tarfile
+import threading
+import zipfile
+import zlib
+from os import stat as osstat
+from queue import Queue, Full
+
+try:
+    import zstandard
+except ImportError:
+    # zstd compression is optional, gzip is always available
+    zstandard = None
+
+COMPRESSION_SUFFIXES = dict(gzip=".gz", zstd=".zst")
+
+
+class IterStream(object):
+    # File-like wrapper around a generator of bytes, so requests can stream it like a file
+    def __init__(self, iterable, length=None):
+        self._iterator = iter(iterable)
+        self._buffer = b""
+        # requests only sends a Content-Length when it knows the size up front
+        self.len = length
+        self.bytes_read = 0
+
+    def __iter__(self):
+        # Without a length, requests falls back to a chunked transfer of the generator
+        if self._buffer:
+            data, self._buffer = self._buffer, b""
+            self.bytes_read += len(data)
+            yield data
+        for data in self._iterator:
+            if data:
+                self.bytes_read += len(data)
+                yield data
+
+    def read(self, size=-1):
+        while size is None or size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._iterator)
+            except StopIteration:
+                break
+        if size is None or size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        self.bytes_read += len(data)
+        return data
+
+
+class _ChunkBuffer(object):
+    # Collects whatever tarfile or zipfile writes, so it can be handed out chunk by chunk
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _tar_name_supported(name):
+    try:
+        return len(name.encode("ascii")) <= 100
+    except UnicodeEncodeError:
+        return False
+
+
+def tar_size(files):
+    # Exact size of the uncompressed ustar stream written by tar_stream, or None if it can't be predicted
+    size = 0
+    for local_file_path, name in files:
+        if not _tar_name_supported(name):
+            return None
+        size += tarfile.BLOCKSIZE + -(-osstat(local_file_path).st_size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+    size += 2 * tarfile.BLOCKSIZE
+    return -(-size // tarfile.RECORDSIZE) * tarfile.RECORDSIZE
+
+
+def tar_stream(files):
+    # Writes a tar archive of (local path, name) pairs without ever keeping more than one file in memory
+    buffer = _ChunkBuffer()
+    fmt = tarfile.USTAR_FORMAT if all(_tar_name_supported(name) for local_file_path, name in files) else tarfile.PAX_FORMAT
+    with tarfile.open(fileobj=buffer, mode="w|", format=fmt) as tar:
+        for local_file_path, name in files:
+            file_stat = osstat(local_file_path)
+            tarinfo = tarfile.TarInfo(name)
+            tarinfo.size = file_stat.st_size
+            tarinfo.mtime = int(file_stat.st_mtime)
+            tarinfo.mode = 0o644
+            with open(local_file_path, "rb") as local_file:
+                tar.addfile(tarinfo, local_file)
+            yield buffer.pop()
+    yield buffer.pop()
+
+
+def zip_stream(files, contents=(), chunk_size=256 * 1024):
+    # Writes a zip archive of (local path, name) pairs and (name, data) pairs while it is being sent, nothing ends up on disk
+    buffer = _ChunkBuffer()
+    # Without seek or tell, zipfile puts the sizes after the data instead of going back for them
+    with zipfile.ZipFile(buffer, mode="w", compression=zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+        for name, data in contents:
+            archive.writestr(name, data)
+        yield buffer.pop()
+        for local_file_path, name in files:
+            try:
+                zipinfo = zipfile.ZipInfo.from_file(local_file_path, name)
+                local_file = open(local_file_path, "rb")
+            except OSError:
+                # Log files and the like may be gone by the time we get to them
+                continue
+            zipinfo.compress_type = zipfile.ZIP_DEFLATED
+            with local_file, archive.open(zipinfo, mode="w") as archive_file:
+                for data in iter(lambda: local_file.read(chunk_size), b""):
+                    archive_file.write(data)
+                    yield buffer.pop()
+            yield buffer.pop()
+    yield buffer.pop()
+
+
+def compress_stream(local_file_path, compression="gzip", chunk_size=256 * 1024):
+    # Compresses the file on the fly, without writing a compressed copy to disk
+    if compression == "zstd":
+        compressor = zstandard.ZstdCompressor(level=9).compressobj()
+    else:
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    with open(local_file_path, "rb") as local_file:
+        for data in iter(lambda: local_file.read(chunk_size), b""):
+            compressed = compressor.compress(data)
+            if compressed:
+                yield compressed
+    yield compressor.flush()
+
+
+def read_file(local_file_path, chunk_size=256 * 1024):
+    with open(local_file_path, "rb") as local_file:
+        for data in iter(lambda: local_file.read(chunk_size), b""):
+            yield data
+
+
+class Tee(object):
+    # Reads a stream once and hands every chunk to several consumers, each uploading from its own thread
+    def __init__(self, iterable, consumers, depth=16):
+        self._iterable = iterable
+        self._queues = [Queue(maxsize=depth) for i in range(consumers)]
+        # Consumers that stopped reading, e.g. because their upload failed, are skipped from then on
+        self._closed = [threading.Event() for i in range(consumers)]
+
+    def stream(self, index):
+        queue = self._queues[index]
+        try:
+            while True:
+                data = queue.get()
+                if data is None:
+                    return
+                yield data
+        finally:
+            self.close(index)
+
+    def close(self, index):
+        self._closed[index].set()
+
+    def run(self):
+        # Only as fast as the slowest consumer, but never more than a few chunks in memory per consumer
+        for data in self._iterable:
+            if not self._send(data):
+                return
+        self._send(None)
+
+    def _send(self, data):
+        waiting = [index for index, closed in enumerate(self._closed) if not closed.is_set()]
+        for index in waiting:
+            while not self._closed[index].is_set():
+                try:
+                    self._queues[index].put(data, timeout=1)
+                    break
+                except Full:
+                    continue
+        return any(not closed.is_set() for closed in self._closed)
@@ -0,0 +1,33 @@
+# coding=utf-8
+from __future__ import absolute_import
+import os
+from os import path as ospath
+
+
+def local_files(folder, recursive=True):
+    # (path relative to folder, stat) of every file, hidden files like OctoPrint's metadata are skipped
+    directories = [""]
+    while directories:
+        directory = directories.pop()
+        try:
+            entries = list(os.scandir(ospath.join(folder, directory)))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            relative_path = ospath.join(directory, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                if recursive:
+                    directories.append(relative_path)
+            elif entry.is_file():
+                yield relative_path, entry.stat()
+
+
+def is_outdated(remote, file_stat, compressed=False):
+    # Compare a remote listing entry with the local file, the size of a compressed upload can't be compared
+    if remote is None:
+        return True
+    if not compressed and remote["size"] != file_stat.st_size:
+        return True
+    return remote["modified"] is not None and remote["modified"].timestamp() < int(file_stat.st_mtime)
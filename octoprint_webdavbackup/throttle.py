@@ -0,0 +1,48 @@
+# coding=utf-8
+from __future__ import absolute_import
+import threading
+import time
+
+
+class TokenBucket(object):
+    # Limits the combined upload speed of all uploads, the rate may change at any time (e.g. when a print starts)
+    def __init__(self, rate=None):
+        # Callable returning the allowed bytes per second, 0 or None for unlimited
+        self._rate = rate
+        self._lock = threading.Lock()
+        self._tokens = 0.0
+        self._last = time.monotonic()
+
+    def set_rate(self, rate):
+        self._rate = rate
+
+    def consume(self, amount):
+        rate = self._rate() if self._rate is not None else None
+        if not rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            # Allow bursts of at most one second worth of data
+            self._tokens = min(rate, self._tokens + (now - self._last) * rate) - amount
+            self._last = now
+            wait = -self._tokens / rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class ThrottledStream(object):
+    # Wraps an upload body so every block sent has to get past the token bucket first
+    def __init__(self, stream, bucket, length=None):
+        self._stream = stream
+        self._bucket = bucket
+        self.len = length
+
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        self._bucket.consume(len(data))
+        return data
+
+    def __iter__(self):
+        for data in self._stream:
+            self._bucket.consume(len(data))
+            yield data
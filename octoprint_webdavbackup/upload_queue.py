@@ -0,0 +1,397 @@
+# coding=utf-8
+from __future__ import absolute_import
+import hashlib
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict
+from queue import PriorityQueue, Empty, Full
+from uuid import uuid4
+from .journal import job_key, PENDING as JOURNAL_PENDING, UPLOADING as JOURNAL_UPLOADING, DONE as JOURNAL_DONE, FAILED as JOURNAL_FAILED
+
+# Job states
+QUEUED = "queued"
+UPLOADING = "uploading"
+DONE = "done"
+RETRYING = "retrying"
+DEFERRED = "deferred"
+FAILED = "failed"
+REJECTED = "rejected"
+
+
+class UploadJob(object):
+    def __init__(self, event, local_file_path, upload_path, upload_name, overwrite=False, remove_after_upload=False, files=None, priority=1, targets=None, relative_path=None):
+        self.id = uuid4().hex
+        self.event = event
+        self.local_file_path = local_file_path
+        # Path within the uploads folder, the filters are matched against it
+        self.relative_path = relative_path
+        self.upload_path = upload_path
+        self.upload_name = upload_name
+        self.overwrite = overwrite
+        self.remove_after_upload = remove_after_upload
+        # A batch job uploads several (local path, name) pairs to upload_path at once
+        self.files = files
+        # Lower goes first
+        self.priority = priority
+        # Destination per target name, without targets everything goes to the primary server
+        self.targets = targets
+        # Targets that have confirmed the upload, these are skipped when the job is retried
+        self.completed = []
+
+        if files:
+            keys = [job_key(local_path) or local_path for local_path, name in files]
+            self.key = "batch:" + hashlib.sha1("\n".join(keys).encode("utf-8")).hexdigest()
+        else:
+            self.key = job_key(local_file_path)
+        # Progress of a chunked upload, kept between attempts
+        self.offset = 0
+        self.chunk_size = None
+
+        self.status = QUEUED
+        self.error = None
+        # Set to False by the upload handler when trying again will not help
+        self.retry = True
+        # Set when a print ended, the printer may still be finishing but the job shouldn't be held back again
+        self.released = False
+        self.attempts = 0
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    def as_dict(self):
+        return dict(
+            id=self.id,
+            key=self.key,
+            event=self.event,
+            local_file_path=self.local_file_path,
+            relative_path=self.relative_path,
+            upload_path=self.upload_path,
+            upload_name=self.upload_name,
+            overwrite=self.overwrite,
+            remove_after_upload=self.remove_after_upload,
+            files=self.files,
+            priority=self.priority,
+            targets=self.targets,
+            completed=self.completed,
+            status=self.status,
+            error=self.error,
+            attempts=self.attempts,
+            offset=self.offset,
+            chunk_size=self.chunk_size,
+            created=self.created,
+            started=self.started,
+            finished=self.finished,
+        )
+
+    @classmethod
+    def from_dict(cls, data):
+        job = cls(
+            event=data["event"],
+            local_file_path=data["local_file_path"],
+            upload_path=data["upload_path"],
+            upload_name=data["upload_name"],
+            overwrite=data.get("overwrite", False),
+            remove_after_upload=data.get("remove_after_upload", False),
+            files=[tuple(entry) for entry in data["files"]] if data.get("files") else None,
+            priority=data.get("priority", 1),
+            targets=data.get("targets"),
+            relative_path=data.get("relative_path"),
+        )
+        job.id = data.get("id", job.id)
+        # Keep the original key, the file may have changed since
+        job.key = data.get("key")
+        job.attempts = data.get("attempts", 0)
+        job.completed = data.get("completed", [])
+        job.offset = data.get("offset", 0)
+        job.chunk_size = data.get("chunk_size")
+        job.created = data.get("created", job.created)
+        return job
+
+
+class UploadQueue(object):
+    def __init__(self, handler, workers=2, max_size=32, history=50, journal=None, max_attempts=10, retry_delay=30, max_retry_delay=3600, hold=None):
+        self._logger = logging.getLogger("octoprint.plugins.webdavbackup.queue")
+        # The handler does the actual upload and returns True on success
+        self._handler = handler
+        self._queue = PriorityQueue(maxsize=max_size)
+        # Keeps jobs with the same priority in order
+        self._sequence = itertools.count()
+        # Jobs that didn't fit into the queue, they are moved over as workers make room
+        self._overflow = []
+        self._history = OrderedDict()
+        self._history_size = history
+        self._lock = threading.Lock()
+        self._workers = []
+        self._worker_count = max(1, workers)
+        self._accepting = False
+        self._stopping = False
+
+        # Optional on-disk journal, used to retry failed uploads and to survive restarts
+        self._journal = journal
+        self._max_attempts = max_attempts
+        self._retry_delay = retry_delay
+        self._max_retry_delay = max_retry_delay
+        self._timers = set()
+
+        # Optional callable deciding whether a job has to wait, e.g. until the current print is done
+        self._hold = hold
+        self._deferred = []
+
+    def start(self):
+        self._accepting = True
+        self._stopping = False
+        self._spawn_workers()
+
+    def set_workers(self, workers):
+        # Surplus workers exit after finishing their current job
+        self._worker_count = max(1, workers)
+        if self._accepting:
+            self._spawn_workers()
+
+    def set_retry(self, max_attempts, retry_delay, max_retry_delay):
+        self._max_attempts = max_attempts
+        self._retry_delay = retry_delay
+        self._max_retry_delay = max_retry_delay
+
+    def enqueue(self, job, again=False):
+        if not self._accepting:
+            self._logger.warning("Upload queue is not accepting jobs, " + job.local_file_path + " will NOT be uploaded")
+            self._set_status(job, REJECTED, "Upload queue is shut down")
+            return False
+
+        if self._journal is not None and not self._journal.add(job, again=again):
+            return False
+
+        return self._put(job)
+
+    def release(self, force=False):
+        # Queue everything that was deferred, jobs that still have to wait will be deferred again unless forced
+        with self._lock:
+            deferred = self._deferred
+            self._deferred = []
+        if deferred:
+            self._logger.info("Resuming " + str(len(deferred)) + " deferred uploads")
+        for job in deferred:
+            job.released = force
+            self._put(job)
+
+    def replay(self):
+        # Pick up everything the journal still has pending, for example after a restart
+        if self._journal is None:
+            return
+        now = time.time()
+        for data, next_attempt in self._journal.pending():
+            job = UploadJob.from_dict(data)
+            self._logger.info("Resuming upload of " + job.local_file_path + " from the upload journal")
+            self._schedule(job, max(0, next_attempt - now))
+
+    def _defer(self, job):
+        if job.released or self._hold is None or not self._hold(job):
+            return False
+        self._logger.info("Deferring upload of " + job.local_file_path)
+        self._set_status(job, DEFERRED)
+        with self._lock:
+            self._deferred.append(job)
+        return True
+
+    def _put(self, job):
+        self._remember(job)
+        if self._defer(job):
+            return True
+        entry = (job.priority, next(self._sequence), job)
+        try:
+            # Never block the caller, this is usually OctoPrint's event thread
+            with self._lock:
+                if self._overflow:
+                    # Don't overtake jobs that are already waiting for room
+                    raise Full()
+                self._queue.put_nowait(entry)
+        except Full:
+            if self._journal is not None and job.key is not None:
+                # The journal remembers the job in case of a restart, so keep it until there is room instead of dropping it
+                self._logger.info("Upload queue is full (" + str(self._queue.maxsize) + " jobs), " + job.local_file_path + " has to wait")
+                self._set_status(job, QUEUED)
+                with self._lock:
+                    heapq.heappush(self._overflow, entry)
+                self._refill()
+                return True
+            self._logger.error("Upload queue is full (" + str(self._queue.maxsize) + " jobs), " + job.local_file_path + " will NOT be uploaded")
+            self._set_status(job, REJECTED, "Upload queue is full")
+            return False
+
+        self._set_status(job, QUEUED)
+        self._logger.debug("Queued upload of " + job.local_file_path + " (" + str(self._queue.qsize()) + " jobs waiting)")
+        return True
+
+    def _refill(self):
+        # Move jobs that didn't fit into the queue over, best priority first
+        with self._lock:
+            while self._overflow and self._accepting:
+                try:
+                    self._queue.put_nowait(self._overflow[0])
+                except Full:
+                    break
+                heapq.heappop(self._overflow)
+
+    def _backoff(self, attempts):
+        # Exponential backoff with jitter, so a recovering server is not hit by all retries at once
+        delay = min(self._max_retry_delay, self._retry_delay * (2 ** max(0, attempts - 1)))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def _retry_later(self, job):
+        delay = self._backoff(job.attempts)
+        self._set_status(job, RETRYING)
+        if self._journal is not None:
+            self._journal.update(job, JOURNAL_PENDING, next_attempt=time.time() + delay)
+        if not self._accepting:
+            # Shutting down, the journal hands it back on the next start
+            self._logger.info("Will retry upload of " + job.local_file_path + " after a restart")
+            return
+        self._logger.info("Will retry upload of " + job.local_file_path + " in " + str(int(delay)) + " seconds")
+        self._schedule(job, delay)
+
+    def _schedule(self, job, delay):
+        if delay <= 0:
+            self._put(job)
+            return
+
+        def _fire():
+            with self._lock:
+                self._timers.discard(timer)
+            if self._accepting:
+                self._put(job)
+
+        self._remember(job)
+        timer = threading.Timer(delay, _fire)
+        timer.daemon = True
+        with self._lock:
+            self._timers.add(timer)
+        timer.start()
+
+    def depth(self):
+        with self._lock:
+            return self._queue.qsize() + len(self._overflow)
+
+    def get_job(self, job_id):
+        with self._lock:
+            return self._history.get(job_id)
+
+    def get_status(self):
+        with self._lock:
+            jobs = [job.as_dict() for job in self._history.values()]
+        return dict(
+            depth=self._queue.qsize(),
+            capacity=self._queue.maxsize,
+            overflow=len(self._overflow),
+            deferred=len(self._deferred),
+            workers=len(self._workers),
+            jobs=jobs,
+        )
+
+    def shutdown(self, timeout=30):
+        # Stop accepting new jobs and give queued jobs a chance to finish
+        self._accepting = False
+        with self._lock:
+            # Pending retries and jobs still waiting for room stay in the journal and are picked up on the next start
+            for timer in self._timers:
+                timer.cancel()
+            self._timers.clear()
+            if self._overflow:
+                self._logger.info(str(len(self._overflow)) + " uploads that were waiting for room in the queue will be uploaded after a restart")
+            self._overflow = []
+        deadline = time.time() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self._logger.warning("Upload queue was not drained within " + str(timeout) + " seconds, " + str(self._queue.unfinished_tasks) + " jobs left")
+                    break
+                self._queue.all_tasks_done.wait(remaining)
+
+        self._stopping = True
+        for worker in list(self._workers):
+            worker.join(max(0.1, deadline - time.time()))
+
+    def _spawn_workers(self):
+        with self._lock:
+            self._workers = [worker for worker in self._workers if worker.is_alive()]
+            while len(self._workers) < self._worker_count:
+                worker = threading.Thread(target=self._work, name="webdavbackup-upload-" + str(len(self._workers)))
+                worker.daemon = True
+                self._workers.append(worker)
+                worker.start()
+
+    def _should_exit(self):
+        if self._stopping:
+            return True
+        with self._lock:
+            alive = [worker for worker in self._workers if worker.is_alive()]
+            if len(alive) > self._worker_count and threading.current_thread() in alive:
+                self._workers.remove(threading.current_thread())
+                return True
+        return False
+
+    def _work(self):
+        while not self._should_exit():
+            try:
+                priority, sequence, job = self._queue.get(timeout=1.0)
+            except Empty:
+                continue
+            self._refill()
+
+            # The situation may have changed while the job was waiting in the queue
+            if self._defer(job):
+                self._queue.task_done()
+                continue
+
+            try:
+                # Later attempts may be held back again
+                job.released = False
+                self._set_status(job, UPLOADING)
+                job.started = time.time()
+                job.attempts += 1
+                job.retry = True
+                job.error = None
+                if self._journal is not None:
+                    self._journal.update(job, JOURNAL_UPLOADING)
+                success = self._handler(job)
+                if not success and not job.error:
+                    job.error = "Upload failed"
+            except Exception as exception:
+                self._logger.exception("Unexpected error while uploading " + job.local_file_path)
+                job.error = str(exception)
+                success = False
+
+            try:
+                job.finished = time.time()
+                if success:
+                    self._set_status(job, DONE)
+                    if self._journal is not None:
+                        self._journal.update(job, JOURNAL_DONE)
+                elif job.retry and self._journal is not None and job.attempts < self._max_attempts:
+                    self._retry_later(job)
+                else:
+                    if job.attempts >= self._max_attempts:
+                        self._logger.error("Giving up on " + job.local_file_path + " after " + str(job.attempts) + " attempts")
+                    self._set_status(job, FAILED)
+                    if self._journal is not None:
+                        self._journal.update(job, JOURNAL_FAILED)
+            except Exception:
+                self._logger.exception("Unable to update the upload journal for " + job.local_file_path)
+            finally:
+                self._queue.task_done()
+
+    def _remember(self, job):
+        with self._lock:
+            self._history[job.id] = job
+            while len(self._history) > self._history_size:
+                self._history.popitem(last=False)
+
+    def _set_status(self, job, status, error=None):
+        job.status = status
+        if error is not None:
+            job.error = error
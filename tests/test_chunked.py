@@ -0,0 +1,174 @@
+# coding=utf-8
+from __future__ import absolute_import
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from os import path as ospath
+
+import requests
+from webdav3.exceptions import ResponseErrorCode
+
+from octoprint_webdavbackup.chunked import ChunkedUpload, nextcloud_uploads_url, NEXTCLOUD_MIN_CHUNK_SIZE
+from octoprint_webdavbackup.client import ClientPool
+from octoprint_webdavbackup.upload_queue import UploadJob
+
+sys.path.insert(0, ospath.join(ospath.dirname(ospath.dirname(ospath.abspath(__file__))), "benchmarks"))
+import fakedav  # noqa: E402
+
+NEXTCLOUD_DIRS = ("/remote.php", "/remote.php/dav", "/remote.php/dav/files", "/remote.php/dav/files/pi", "/remote.php/dav/files/pi/backups",
+                  "/remote.php/dav/uploads", "/remote.php/dav/uploads/pi")
+
+
+class NextcloudUploadsUrlTest(unittest.TestCase):
+    def test_files_endpoint(self):
+        self.assertEqual(nextcloud_uploads_url("https://cloud.example.com/remote.php/dav/files/pi", "pi"), "https://cloud.example.com/remote.php/dav/uploads/pi")
+
+    def test_legacy_endpoint(self):
+        self.assertIsNone(nextcloud_uploads_url("https://cloud.example.com/remote.php/webdav", "pi"))
+
+    def test_other_servers(self):
+        self.assertIsNone(nextcloud_uploads_url("https://nas.example.com/webdav", "pi"))
+        self.assertIsNone(nextcloud_uploads_url("https://cloud.example.com/remote.php/dav/files/pi", None))
+
+
+class ChunkedUploadTest(unittest.TestCase):
+    def setUp(self):
+        self.server, self.store = fakedav.serve()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = "http://127.0.0.1:%d" % self.server.server_address[1]
+        self.folder = tempfile.mkdtemp()
+        self.pool = ClientPool()
+        self.capabilities = dict()
+        # (method, path, Content-Range) of every request sent
+        self.sent = []
+        # Called with the method, path and number of the request, returns a status code to answer with instead
+        self.intercept = None
+
+    def tearDown(self):
+        self.pool.reset()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.folder)
+
+    def _client(self, path=""):
+        client = self.pool.get({"webdav_hostname": self.url + path, "webdav_login": "pi", "webdav_password": "secret", "disable_check": True})
+        request = client.session.request
+
+        def _request(method, url, *args, **kwargs):
+            path = requests.utils.urlparse(url).path
+            self.sent.append((method, path, (kwargs.get("headers") or {}).get("Content-Range")))
+            status = self.intercept(method, path, len(self.sent)) if self.intercept else None
+            if status == "disconnect":
+                raise requests.exceptions.ConnectionError("Connection reset by peer")
+            if status is not None:
+                response = requests.Response()
+                response.status_code = status
+                response._content = b""
+                return response
+            return request(method, url, *args, **kwargs)
+
+        client.session.request = _request
+        return client
+
+    def _job(self, size):
+        local_file_path = ospath.join(self.folder, "backup.zip")
+        with open(local_file_path, "wb") as f:
+            f.write(os.urandom(size))
+        return UploadJob(event="plugin_backup_backup_created", local_file_path=local_file_path, upload_path="/backups", upload_name="backup.zip")
+
+    def _upload(self, client, job, chunk_size=1000):
+        ChunkedUpload(client, chunk_size, self.capabilities).upload(job, job.local_file_path, "/backups/backup.zip")
+
+    def _puts(self):
+        return [(path, content_range) for method, path, content_range in self.sent if method == "PUT"]
+
+    def test_ranges_resume_after_an_interruption(self):
+        self.store.dirs.add("/backups")
+        client = self._client()
+        job = self._job(3500)
+        self.intercept = lambda method, path, count: "disconnect" if method == "PUT" and len(self._puts()) == 3 else None
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self._upload(client, job)
+        self.assertEqual(job.offset, 2000)
+
+        self.intercept = None
+        del self.sent[:]
+        self._upload(client, job)
+        # Only the part the server doesn't have yet is sent again
+        self.assertEqual(self._puts(), [("/backups/backup.zip", "bytes 2000-2999/3500"), ("/backups/backup.zip", "bytes 3000-3499/3500")])
+        self.assertEqual(self.store.files["/backups/backup.zip"][0], 3500)
+
+    def test_resume_only_trusts_the_server(self):
+        self.store.dirs.add("/backups")
+        client = self._client()
+        job = self._job(3500)
+        job.offset = 3000
+        self.store.files["/backups/backup.zip"] = (1000, 0)
+        self._upload(client, job)
+        self.assertEqual(self._puts()[0], ("/backups/backup.zip", "bytes 1000-1999/3500"))
+        self.assertEqual(self.store.files["/backups/backup.zip"][0], 3500)
+
+    def test_whole_file_without_range_support(self):
+        self.store.dirs.add("/backups")
+        client = self._client()
+        job = self._job(3500)
+        self.intercept = lambda method, path, count: 501 if method == "PUT" and self._puts()[-1][1] else None
+        self._upload(client, job)
+        self.assertEqual(self.capabilities, {self.url: False})
+        self.assertEqual(self._puts()[-1], ("/backups/backup.zip", None))
+        self.assertEqual(self.store.files["/backups/backup.zip"][0], 3500)
+
+    def test_nextcloud_resumes_missing_chunks(self):
+        self.store.dirs.update(NEXTCLOUD_DIRS)
+        client = self._client("/remote.php/dav/files/pi")
+        job = self._job(2 * NEXTCLOUD_MIN_CHUNK_SIZE + 5)
+        self.intercept = lambda method, path, count: "disconnect" if method == "PUT" and len(self._puts()) == 2 else None
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self._upload(client, job)
+        self.assertEqual(job.offset, NEXTCLOUD_MIN_CHUNK_SIZE)
+
+        self.intercept = None
+        del self.sent[:]
+        self._upload(client, job)
+        self.assertEqual([ospath.basename(path) for path, content_range in self._puts()], ["00002", "00003"])
+        self.assertEqual(self.sent[-1][0:2], ("MOVE", ospath.dirname(self._puts()[0][0]) + "/.file"))
+        self.assertEqual(self.store.files["/remote.php/dav/files/pi/backups/backup.zip"][0], 2 * NEXTCLOUD_MIN_CHUNK_SIZE + 5)
+
+    def test_nextcloud_falls_back_when_chunking_is_refused(self):
+        self.store.dirs.update(NEXTCLOUD_DIRS)
+        client = self._client("/remote.php/dav/files/pi")
+        job = self._job(NEXTCLOUD_MIN_CHUNK_SIZE + 5)
+        self.intercept = lambda method, path, count: 403 if path.endswith("/.file") else None
+        self._upload(client, job)
+        self.assertEqual(self.capabilities, {self.url + "/remote.php/dav/uploads/pi": False})
+        self.assertEqual(self.store.files["/remote.php/dav/files/pi/backups/backup.zip"][0], NEXTCLOUD_MIN_CHUNK_SIZE + 5)
+
+        # Later uploads go straight to ranged uploads
+        del self.sent[:]
+        self._upload(client, self._job(NEXTCLOUD_MIN_CHUNK_SIZE + 5), chunk_size=NEXTCLOUD_MIN_CHUNK_SIZE)
+        self.assertFalse([path for method, path, content_range in self.sent if "/uploads/" in path])
+
+    def test_nextcloud_retries_transient_errors(self):
+        self.store.dirs.update(NEXTCLOUD_DIRS)
+        client = self._client("/remote.php/dav/files/pi")
+        job = self._job(NEXTCLOUD_MIN_CHUNK_SIZE + 5)
+        self.intercept = lambda method, path, count: 429 if method == "PUT" else None
+        with self.assertRaises(ResponseErrorCode):
+            self._upload(client, job)
+        self.assertEqual(self.capabilities, dict())
+
+    def test_legacy_nextcloud_endpoint_uses_ranges(self):
+        self.store.dirs.update(NEXTCLOUD_DIRS + ("/remote.php/webdav", "/remote.php/webdav/backups"))
+        client = self._client("/remote.php/webdav")
+        self._upload(client, self._job(3500))
+        self.assertFalse([path for method, path, content_range in self.sent if "/uploads/" in path])
+        self.assertEqual(self.store.files["/remote.php/webdav/backups/backup.zip"][0], 3500)
+
+
+if __name__ == "__main__":
+    unittest.main()
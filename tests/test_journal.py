@@ -0,0 +1,120 @@
+# coding=utf-8
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from octoprint_webdavbackup.journal import UploadJournal, job_key, PENDING, UPLOADING, DONE, FAILED
+from octoprint_webdavbackup.upload_queue import UploadJob
+
+
+class JournalTestCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.journal = UploadJournal(os.path.join(self.folder, "journal.db"))
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.folder)
+
+    def _file(self, name, content=b"content"):
+        path = os.path.join(self.folder, name)
+        with open(path, "wb") as f:
+            f.write(content)
+        return path
+
+    def _job(self, name, **kwargs):
+        # The same file every time, rewriting it would change its key
+        path = os.path.join(self.folder, name)
+        if not os.path.exists(path):
+            self._file(name)
+        return UploadJob(event="FileAdded", local_file_path=path, upload_path="/", upload_name=name, **kwargs)
+
+
+class JobKeyTest(JournalTestCase):
+    def test_missing_file(self):
+        self.assertIsNone(job_key(os.path.join(self.folder, "missing")))
+
+    def test_changes_with_the_file(self):
+        path = self._file("a.gcode")
+        key = job_key(path)
+        self.assertEqual(job_key(path), key)
+        self._file("a.gcode", b"longer content")
+        self.assertNotEqual(job_key(path), key)
+
+    def test_changes_with_the_modification_time(self):
+        path = self._file("a.gcode")
+        key = job_key(path)
+        os.utime(path, ns=(0, 1000000000))
+        self.assertNotEqual(job_key(path), key)
+
+
+class UploadJournalTest(JournalTestCase):
+    def test_duplicates_are_skipped(self):
+        job = self._job("a.gcode")
+        self.assertTrue(self.journal.add(job))
+        self.assertFalse(self.journal.add(self._job("a.gcode")))
+
+    def test_uploaded_files_are_skipped_unless_asked_again(self):
+        job = self._job("a.gcode")
+        self.journal.add(job)
+        self.journal.update(job, DONE)
+        self.assertFalse(self.journal.add(self._job("a.gcode")))
+        self.assertTrue(self.journal.add(self._job("a.gcode"), again=True))
+
+    def test_again_does_not_duplicate_pending_uploads(self):
+        self.journal.add(self._job("a.gcode"))
+        for status in (PENDING, UPLOADING):
+            job = self._job("a.gcode")
+            self.journal.update(job, status)
+            self.assertFalse(self.journal.add(self._job("a.gcode"), again=True))
+
+    def test_failed_uploads_can_be_added_again(self):
+        job = self._job("a.gcode")
+        self.journal.add(job)
+        self.journal.update(job, FAILED)
+        self.assertTrue(self.journal.add(self._job("a.gcode")))
+
+    def test_jobs_without_key_are_not_recorded(self):
+        job = UploadJob(event="FileAdded", local_file_path=os.path.join(self.folder, "missing"), upload_path="/", upload_name="missing")
+        self.assertTrue(self.journal.add(job))
+        self.assertTrue(self.journal.add(job))
+        self.assertEqual(self.journal.pending(), [])
+
+    def test_pending(self):
+        later, uploading, done = self._job("later.gcode"), self._job("uploading.gcode"), self._job("done.gcode")
+        for job in (later, uploading, done):
+            self.journal.add(job)
+        self.journal.update(later, PENDING, next_attempt=time.time() + 60)
+        self.journal.update(uploading, UPLOADING)
+        self.journal.update(done, DONE)
+        # Uploads interrupted by a restart come first, retries when they are due
+        self.assertEqual([data["upload_name"] for data, next_attempt in self.journal.pending()], ["uploading.gcode", "later.gcode"])
+
+    def test_pending_jobs_can_be_restored(self):
+        job = self._job("a.gcode", targets=dict(primary=dict(upload_path="/", upload_name="a.gcode")), priority=0)
+        job.completed = ["offsite"]
+        job.offset = 1024
+        self.journal.add(job)
+        self.journal.update(job, PENDING)
+        restored = UploadJob.from_dict(self.journal.pending()[0][0])
+        self.assertEqual(restored.key, job.key)
+        self.assertEqual(restored.targets, job.targets)
+        self.assertEqual(restored.completed, ["offsite"])
+        self.assertEqual(restored.offset, 1024)
+        self.assertEqual(restored.priority, 0)
+
+    def test_prune_keeps_pending_uploads(self):
+        done, pending = self._job("done.gcode"), self._job("pending.gcode")
+        for job in (done, pending):
+            self.journal.add(job)
+        self.journal.update(done, DONE)
+        self.journal.prune(max_age=-1)
+        self.assertTrue(self.journal.add(self._job("done.gcode")))
+        self.assertFalse(self.journal.add(self._job("pending.gcode")))
+
+
+if __name__ == "__main__":
+    unittest.main()
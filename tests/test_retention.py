@@ -0,0 +1,201 @@
+# coding=utf-8
+from __future__ import absolute_import
+import sys
+import threading
+import time
+import unittest
+from datetime import datetime, timedelta, timezone
+from os import path as ospath
+
+from octoprint_webdavbackup import WebDavBackupPlugin
+from octoprint_webdavbackup.client import ClientPool
+from octoprint_webdavbackup.retention import RetentionPolicy, list_files, pattern_depth, prune, select_expired, static_prefix, template_pattern
+
+sys.path.insert(0, ospath.join(ospath.dirname(ospath.dirname(ospath.abspath(__file__))), "benchmarks"))
+import fakedav  # noqa: E402
+
+NOW = datetime(2026, 10, 17, 12, 0, tzinfo=timezone.utc)
+
+
+def _file(path, age=timedelta(), size=1):
+    return dict(path=path, size=size, modified=NOW - age, isdir=False)
+
+
+def _paths(entries):
+    return sorted(entry["path"] for entry in entries)
+
+
+class SelectExpiredTest(unittest.TestCase):
+    def test_nothing_to_select(self):
+        self.assertEqual(select_expired([], keep_last=1), [])
+
+    def test_without_rules_everything_is_kept(self):
+        files = [_file("/a.zip"), _file("/b.zip", timedelta(days=1))]
+        self.assertEqual(select_expired(files), [])
+
+    def test_keep_last(self):
+        files = [_file("/%d.zip" % day, timedelta(days=day)) for day in range(5)]
+        self.assertEqual(_paths(select_expired(files, keep_last=2)), ["/2.zip", "/3.zip", "/4.zip"])
+
+    def test_keep_daily_keeps_the_newest_of_each_day(self):
+        files = [
+            _file("/today-new.zip", timedelta(hours=1)),
+            _file("/today-old.zip", timedelta(hours=2)),
+            _file("/yesterday.zip", timedelta(days=1)),
+            _file("/older.zip", timedelta(days=2)),
+        ]
+        self.assertEqual(_paths(select_expired(files, keep_daily=2)), ["/older.zip", "/today-old.zip"])
+
+    def test_rules_are_combined(self):
+        files = [_file("/%d.zip" % week, timedelta(weeks=week)) for week in range(6)]
+        # The last one and one per week for three weeks
+        self.assertEqual(_paths(select_expired(files, keep_last=1, keep_weekly=3)), ["/3.zip", "/4.zip", "/5.zip"])
+
+    def test_max_size(self):
+        files = [_file("/%d.zip" % day, timedelta(days=day), size=10) for day in range(4)]
+        self.assertEqual(_paths(select_expired(files, max_size=25)), ["/2.zip", "/3.zip"])
+
+    def test_most_recent_is_always_kept(self):
+        files = [_file("/new.zip", size=100), _file("/old.zip", timedelta(days=1), size=1)]
+        self.assertEqual(_paths(select_expired(files, max_size=10)), ["/old.zip"])
+
+
+class PatternTest(unittest.TestCase):
+    def test_template_pattern(self):
+        self.assertEqual(template_pattern("/backups/%Y/%m"), "/backups/*/*")
+        self.assertEqual(template_pattern("backup-%-d-100%%"), "backup-*-100%")
+        self.assertEqual(template_pattern("/%D"), "/*/*/*")
+        self.assertEqual(template_pattern(None), "")
+
+    def test_static_prefix(self):
+        self.assertEqual(static_prefix("/backups/%Y/%m"), "/backups")
+        self.assertEqual(static_prefix("backups/octoprint"), "/backups/octoprint")
+        self.assertEqual(static_prefix("/%Y"), "/")
+        self.assertEqual(static_prefix(None), "/")
+
+    def test_pattern_depth(self):
+        self.assertEqual(pattern_depth(["/*-backup-*.zip"], "/"), 1)
+        self.assertEqual(pattern_depth(["/backups/*/*/*.zip", "/backups/*.zip"], "/backups"), 3)
+        self.assertEqual(pattern_depth(["/backups/" + template_pattern("%D") + "/*.zip"], "/backups"), 4)
+        self.assertEqual(pattern_depth([], "/"), 0)
+
+    def test_wildcards_do_not_cross_directories(self):
+        policy = RetentionPolicy(["/backups/*/*.zip"], keep_last=1)
+        self.assertTrue(policy.matches("/backups/2026/a.zip"))
+        self.assertFalse(policy.matches("/backups/a.zip"))
+        self.assertFalse(policy.matches("/backups/2026/10/a.zip"))
+        self.assertFalse(policy.matches("/backups/2026/a.zip.tmp"))
+
+    def test_files_elsewhere_never_expire(self):
+        policy = RetentionPolicy(["/*.zip"], keep_last=1)
+        files = [_file("/new.zip"), _file("/old.zip", timedelta(days=1)), _file("/Documents/taxes.zip", timedelta(days=2))]
+        self.assertEqual(_paths(policy.expired(files)), ["/old.zip"])
+
+    def test_without_patterns_nothing_expires(self):
+        policy = RetentionPolicy([], keep_last=1)
+        self.assertFalse(policy.active())
+        self.assertEqual(policy.expired([_file("/a.zip"), _file("/b.zip", timedelta(days=1))]), [])
+
+
+class _Settings(object):
+    def __init__(self, values):
+        self._values = values
+
+    def get_int(self, path, **kwargs):
+        return self._values.get(path[0], 0)
+
+
+class PolicyTest(unittest.TestCase):
+    def _policy(self, kind, **target):
+        plugin = WebDavBackupPlugin()
+        plugin._settings = _Settings({"retention_" + kind + "_keep_last": 1})
+        settings = dict(name="primary", upload_path="/", upload_name=None, upload_timelapse_path=None, upload_timelapse_name=None)
+        settings.update(target)
+        return plugin._get_retention_policy(kind, settings)
+
+    def test_backups_in_a_dated_path(self):
+        prefix, policy = self._policy("backup", upload_path="/backups/%Y/%m", upload_name="octoprint_%Y%m%d")
+        self.assertEqual(prefix, "/backups")
+        self.assertTrue(policy.matches("/backups/2026/10/octoprint_20261017.zip"))
+        self.assertTrue(policy.matches("/backups/2026/10/octoprint_20261017.zip.gz"))
+        self.assertFalse(policy.matches("/backups/2026/octoprint_20261017.zip"))
+        self.assertFalse(policy.matches("/backups/2026/10/old/octoprint_20261017.zip"))
+        self.assertFalse(policy.matches("/backups/2026/10/other.zip"))
+
+    def test_default_backup_names_in_the_root(self):
+        prefix, policy = self._policy("backup")
+        self.assertEqual(prefix, "/")
+        self.assertTrue(policy.active())
+        self.assertTrue(policy.matches("/octoprint-backup-20261017-120000.zip"))
+        self.assertFalse(policy.matches("/taxes.zip"))
+        self.assertFalse(policy.matches("/Documents/taxes.zip"))
+        self.assertFalse(policy.matches("/Documents/octoprint-backup-20261017-120000.zip"))
+
+    def test_root_without_a_specific_name_is_refused(self):
+        self.assertFalse(self._policy("timelapse")[1].active())
+        self.assertFalse(self._policy("backup", upload_name="%Y-%m-%d")[1].active())
+
+    def test_timelapses(self):
+        prefix, policy = self._policy("timelapse", upload_timelapse_path="/timelapse")
+        self.assertEqual(prefix, "/timelapse")
+        self.assertTrue(policy.matches("/timelapse/print_20261017.mp4"))
+        self.assertFalse(policy.matches("/timelapse/print_20261017.jpg"))
+        self.assertFalse(policy.matches("/timelapse/old/print_20261017.mp4"))
+
+
+class ListFilesTest(unittest.TestCase):
+    def setUp(self):
+        self.servers = []
+        self.pool = ClientPool()
+
+    def tearDown(self):
+        self.pool.reset()
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def _serve(self, deny_infinity=False):
+        server, store = fakedav.serve(deny_infinity=deny_infinity)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.servers.append(server)
+        client = self.pool.get({"webdav_hostname": "http://127.0.0.1:%d" % server.server_address[1], "disable_check": True})
+        # Backups in dated folders, next to a lot of unrelated folders
+        store.dirs.update(["/backups", "/backups/2026", "/backups/2026/10", "/backups/2026/10/old"])
+        for index in range(20):
+            store.dirs.update(["/folder%d" % index, "/folder%d/sub" % index])
+            store.files["/folder%d/sub/file.txt" % index] = (1, time.time())
+        for name in ("/octoprint-backup-1.zip", "/backups/x.zip", "/backups/2026/10/a.zip", "/backups/2026/10/old/b.zip"):
+            store.files[name] = (1, time.time())
+        return store, client
+
+    def test_depth_one_in_the_root(self):
+        for deny_infinity in (False, True):
+            store, client = self._serve(deny_infinity)
+            files = list_files(client, "/", max_depth=1)
+            self.assertEqual(sorted(entry["path"] for entry in files), ["/octoprint-backup-1.zip"])
+            self.assertEqual(store.requests["PROPFIND"], 1)
+
+    def test_only_walks_as_deep_as_needed(self):
+        store, client = self._serve(deny_infinity=True)
+        files = list_files(client, "/backups", max_depth=3)
+        self.assertEqual(sorted(entry["path"] for entry in files), ["/backups/2026/10/a.zip", "/backups/x.zip"])
+        # /backups, /backups/2026 and /backups/2026/10, but not /backups/2026/10/old
+        self.assertEqual(store.requests["PROPFIND"], 4)
+
+    def test_unbounded(self):
+        store, client = self._serve(deny_infinity=True)
+        files = list_files(client, "/backups")
+        self.assertEqual(len(files), 3)
+
+    def test_prune_in_the_root_leaves_other_folders_alone(self):
+        store, client = self._serve(deny_infinity=True)
+        store.files["/octoprint-backup-2.zip"] = (1, time.time() - 60)
+        deleted = prune(client, "/", [RetentionPolicy(["/*-backup-*.zip"], keep_last=1)])
+        self.assertEqual(deleted, ["/octoprint-backup-2.zip"])
+        self.assertEqual(store.requests["PROPFIND"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
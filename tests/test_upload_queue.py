@@ -0,0 +1,261 @@
+# coding=utf-8
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from octoprint_webdavbackup.journal import UploadJournal
+from octoprint_webdavbackup.upload_queue import UploadJob, UploadQueue, DEFERRED, DONE, FAILED, REJECTED, RETRYING
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class _Handler(object):
+    # Records the uploads, fails while there are failures left and waits while the gate is closed
+    def __init__(self, failures=0, retry=True):
+        self.uploaded = []
+        self.attempted = []
+        self.failures = failures
+        self.retry = retry
+        self.gate = threading.Event()
+        self.gate.set()
+        self.started = threading.Event()
+
+    def __call__(self, job):
+        self.attempted.append(job.upload_name)
+        self.started.set()
+        self.gate.wait(5)
+        if self.failures:
+            self.failures -= 1
+            job.error = "Server unavailable"
+            job.retry = self.retry
+            return False
+        self.uploaded.append(job.upload_name)
+        return True
+
+
+class UploadQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.journal = UploadJournal(os.path.join(self.folder, "journal.db"))
+        self.queues = []
+
+    def tearDown(self):
+        for queue in self.queues:
+            queue.shutdown(timeout=1)
+        self.journal.close()
+        shutil.rmtree(self.folder)
+
+    def _queue(self, handler, journal=True, **kwargs):
+        options = dict(workers=1, max_size=4, retry_delay=0.01, max_retry_delay=0.05)
+        options.update(kwargs)
+        queue = UploadQueue(handler, journal=self.journal if journal else None, **options)
+        self.queues.append(queue)
+        queue.start()
+        return queue
+
+    def _job(self, name, **kwargs):
+        path = os.path.join(self.folder, name)
+        with open(path, "wb") as f:
+            f.write(name.encode("utf-8"))
+        return UploadJob(event="FileAdded", local_file_path=path, upload_path="/", upload_name=name, **kwargs)
+
+    def _journal_status(self):
+        return dict((data["upload_name"], (data["status"], next_attempt)) for data, next_attempt in self.journal.pending())
+
+
+class BackpressureTest(UploadQueueTestCase):
+    def test_a_full_queue_does_not_block(self):
+        handler = _Handler()
+        handler.gate.clear()
+        queue = self._queue(handler, max_size=2)
+        start = time.time()
+        for index in range(10):
+            self.assertTrue(queue.enqueue(self._job("%d.gcode" % index)))
+        self.assertLess(time.time() - start, 1)
+        self.assertTrue(queue.get_status()["overflow"] > 0)
+        self.assertEqual(queue.depth(), 10 - len(handler.attempted))
+
+        handler.gate.set()
+        self.assertTrue(_wait_for(lambda: len(handler.uploaded) == 10))
+        self.assertEqual(handler.uploaded, ["%d.gcode" % index for index in range(10)])
+        self.assertEqual(queue.get_status()["overflow"], 0)
+
+    def test_waiting_jobs_go_by_priority(self):
+        handler = _Handler()
+        handler.gate.clear()
+        queue = self._queue(handler, max_size=1)
+        queue.enqueue(self._job("first.gcode"))
+        self.assertTrue(handler.started.wait(1))
+        for name, priority in (("a.gcode", 2), ("b.gcode", 2), ("movie.mp4", 0), ("backup.zip", 1)):
+            queue.enqueue(self._job(name, priority=priority))
+        handler.gate.set()
+        self.assertTrue(_wait_for(lambda: len(handler.uploaded) == 5))
+        self.assertEqual(handler.uploaded, ["first.gcode", "a.gcode", "movie.mp4", "backup.zip", "b.gcode"])
+
+    def test_full_queue_without_journal_rejects(self):
+        handler = _Handler()
+        handler.gate.clear()
+        queue = self._queue(handler, journal=False, max_size=1)
+        queue.enqueue(self._job("first.gcode"))
+        self.assertTrue(handler.started.wait(1))
+        self.assertTrue(queue.enqueue(self._job("second.gcode")))
+        job = self._job("third.gcode")
+        self.assertFalse(queue.enqueue(job))
+        self.assertEqual(job.status, REJECTED)
+        handler.gate.set()
+
+    def test_duplicates_are_not_queued(self):
+        handler = _Handler()
+        queue = self._queue(handler)
+        job = self._job("a.gcode")
+        self.assertTrue(queue.enqueue(job))
+        self.assertTrue(_wait_for(lambda: handler.uploaded == ["a.gcode"]))
+        self.assertFalse(queue.enqueue(UploadJob(event="FileAdded", local_file_path=job.local_file_path, upload_path="/", upload_name="a.gcode")))
+
+
+class RetryTest(UploadQueueTestCase):
+    def test_backoff(self):
+        queue = UploadQueue(_Handler(), retry_delay=10, max_retry_delay=60)
+        for attempts, delay in ((1, 10), (2, 20), (3, 40), (4, 60), (20, 60)):
+            for _ in range(20):
+                self.assertTrue(delay / 2 <= queue._backoff(attempts) <= delay)
+
+    def test_failed_uploads_are_retried(self):
+        handler = _Handler(failures=2)
+        queue = self._queue(handler)
+        job = self._job("a.gcode")
+        queue.enqueue(job)
+        self.assertTrue(_wait_for(lambda: handler.uploaded == ["a.gcode"]))
+        self.assertEqual(job.attempts, 3)
+        self.assertTrue(_wait_for(lambda: job.status == DONE))
+        self.assertEqual(self._journal_status(), dict())
+
+    def test_gives_up_after_max_attempts(self):
+        handler = _Handler(failures=10)
+        queue = self._queue(handler, max_attempts=3)
+        job = self._job("a.gcode")
+        queue.enqueue(job)
+        self.assertTrue(_wait_for(lambda: job.status == FAILED))
+        self.assertEqual(handler.attempted, ["a.gcode"] * 3)
+
+    def test_permanent_errors_are_not_retried(self):
+        handler = _Handler(failures=1, retry=False)
+        queue = self._queue(handler)
+        job = self._job("a.gcode")
+        queue.enqueue(job)
+        self.assertTrue(_wait_for(lambda: job.status == FAILED))
+        time.sleep(0.1)
+        self.assertEqual(handler.attempted, ["a.gcode"])
+
+    def test_no_retries_without_journal(self):
+        handler = _Handler(failures=1)
+        queue = self._queue(handler, journal=False)
+        job = self._job("a.gcode")
+        queue.enqueue(job)
+        self.assertTrue(_wait_for(lambda: job.status == FAILED))
+
+
+class DeferralTest(UploadQueueTestCase):
+    def setUp(self):
+        super(DeferralTest, self).setUp()
+        self.printing = True
+
+    def _hold(self, job):
+        return self.printing
+
+    def test_held_back_while_printing(self):
+        handler = _Handler()
+        queue = self._queue(handler, hold=self._hold)
+        job = self._job("a.gcode")
+        queue.enqueue(job)
+        self.assertEqual(job.status, DEFERRED)
+        self.assertEqual(queue.get_status()["deferred"], 1)
+
+        # Still printing, so it has to wait again
+        queue.release()
+        self.assertEqual(job.status, DEFERRED)
+        self.printing = False
+        queue.release()
+        self.assertTrue(_wait_for(lambda: handler.uploaded == ["a.gcode"]))
+
+    def test_forced_release_while_the_printer_finishes(self):
+        handler = _Handler()
+        queue = self._queue(handler, hold=self._hold)
+        queue.enqueue(self._job("a.gcode"))
+        queue.release(force=True)
+        self.assertTrue(_wait_for(lambda: handler.uploaded == ["a.gcode"]))
+        self.assertEqual(queue.get_status()["deferred"], 0)
+
+    def test_retries_are_held_back_again(self):
+        handler = _Handler(failures=1)
+        queue = self._queue(handler, hold=self._hold)
+        job = self._job("a.gcode")
+        queue.enqueue(job)
+        queue.release(force=True)
+        self.assertTrue(_wait_for(lambda: job.status == DEFERRED and job.attempts == 1))
+        self.assertEqual(handler.uploaded, [])
+
+
+class ShutdownTest(UploadQueueTestCase):
+    def test_pending_retries_stay_in_the_journal(self):
+        handler = _Handler(failures=1)
+        queue = self._queue(handler, retry_delay=60, max_retry_delay=60)
+        queue.enqueue(self._job("a.gcode"))
+        self.assertTrue(_wait_for(lambda: self._journal_status().get("a.gcode", (None,))[0] == RETRYING))
+        queue.shutdown(timeout=1)
+        self.assertEqual(handler.attempted, ["a.gcode"])
+        self.assertEqual(queue._timers, set())
+        data, next_attempt = self.journal.pending()[0]
+        self.assertEqual(data["status"], RETRYING)
+        self.assertGreater(next_attempt, time.time())
+
+    def test_failing_during_shutdown_stays_pending(self):
+        handler = _Handler(failures=1)
+        handler.gate.clear()
+        queue = self._queue(handler)
+        queue.enqueue(self._job("a.gcode"))
+        self.assertTrue(handler.started.wait(1))
+        shutdown = threading.Thread(target=queue.shutdown, kwargs=dict(timeout=5))
+        shutdown.start()
+        self.assertTrue(_wait_for(lambda: not queue._accepting))
+        handler.gate.set()
+        shutdown.join(5)
+        self.assertEqual(handler.attempted, ["a.gcode"])
+        self.assertEqual([data["upload_name"] for data, next_attempt in self.journal.pending()], ["a.gcode"])
+
+    def test_waiting_jobs_are_replayed(self):
+        handler = _Handler()
+        handler.gate.clear()
+        queue = self._queue(handler, max_size=1)
+        for index in range(4):
+            queue.enqueue(self._job("%d.gcode" % index))
+        self.assertTrue(handler.started.wait(1))
+        shutdown = threading.Thread(target=queue.shutdown, kwargs=dict(timeout=5))
+        shutdown.start()
+        self.assertTrue(_wait_for(lambda: not queue._accepting))
+        handler.gate.set()
+        shutdown.join(5)
+        # The first one was uploading, the one in the queue is drained, the rest has to wait for the next start
+        self.assertEqual(handler.uploaded, ["0.gcode", "1.gcode"])
+        self.assertEqual(sorted(data["upload_name"] for data, next_attempt in self.journal.pending()), ["2.gcode", "3.gcode"])
+
+        handler = _Handler()
+        queue = self._queue(handler)
+        queue.replay()
+        self.assertTrue(_wait_for(lambda: sorted(handler.uploaded) == ["2.gcode", "3.gcode"]))
+        self.assertEqual(self.journal.pending(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()